@@ -0,0 +1,148 @@
+import os
+import time
+import argparse
+
+# XLA flags are read once, so enable CPU auto-clustering before any setting runs
+os.environ.setdefault("TF_XLA_FLAGS", "--tf_xla_cpu_global_jit")
+
+import numpy as np
+import tensorflow as tf
+import keras_tuner as kt
+
+from settings.default import INDUSTRY_MAPPING
+from settings.fixed_params import MODLE_PARAMS
+from mom_trans.backtest import _load_features
+from mom_trans.model_inputs import ModelFeatures
+from mom_trans.deep_momentum_network import LstmDeepMomentumNetworkModel
+from mom_trans.momentum_transformer import TftDeepMomentumNetworkModel
+
+# (jit_compile, mixed_precision) settings to compare against the baseline
+ACCELERATION_SETTINGS = [(False, False), (True, False), (False, True), (True, True)]
+BATCH_SIZE = 64
+
+
+def main(architecture: str, features_file_path: str, time_steps: int, epochs: int):
+    model_features = ModelFeatures(
+        _load_features(features_file_path),
+        time_steps,
+        start_boundary=1990,
+        test_boundary=2000,
+        test_end=2001,
+        train_valid_ratio=MODLE_PARAMS["train_valid_ratio"],
+        asset_class_dictionary=INDUSTRY_MAPPING,
+    )
+    data, labels, active_flags, _, _ = ModelFeatures._unpack(model_features.train)
+    steps_per_epoch = int(np.ceil(len(data) / BATCH_SIZE))
+
+    for jit_compile, mixed_precision in ACCELERATION_SETTINGS:
+        tf.keras.backend.clear_session()
+        params = MODLE_PARAMS.copy()
+        params["architecture"] = architecture
+        params["total_time_steps"] = time_steps
+        params["transaction_costs"] = None
+        params["jit_compile"] = jit_compile
+        params["mixed_precision"] = mixed_precision
+
+        hp_directory = os.path.join("results", "benchmark_training", "hp")
+        if architecture == "LSTM":
+            dmn = LstmDeepMomentumNetworkModel(
+                "benchmark",
+                hp_directory,
+                [BATCH_SIZE],
+                **params,
+                **model_features.input_params,
+            )
+        else:
+            dmn = TftDeepMomentumNetworkModel(
+                "benchmark",
+                hp_directory,
+                [BATCH_SIZE],
+                **params,
+                **model_features.input_params,
+                **{
+                    "column_definition": model_features.get_column_definition(),
+                    "num_encoder_steps": 0,
+                    "stack_size": 1,
+                    "num_heads": 4,
+                },
+            )
+        # default (first) value of every hyperparameter
+        model = dmn.model_builder(kt.HyperParameters())
+
+        # first epoch includes tracing and compilation
+        model.fit(
+            data,
+            labels,
+            sample_weight=active_flags,
+            batch_size=BATCH_SIZE,
+            epochs=1,
+            verbose=0,
+        )
+        start = time.time()
+        model.fit(
+            data,
+            labels,
+            sample_weight=active_flags,
+            batch_size=BATCH_SIZE,
+            epochs=epochs,
+            verbose=0,
+        )
+        steps_per_sec = epochs * steps_per_epoch / (time.time() - start)
+        print(
+            f"jit_compile={jit_compile}, mixed_precision={mixed_precision}: "
+            f"{steps_per_sec:.2f} steps/sec"
+        )
+
+
+if __name__ == "__main__":
+
+    def get_args():
+        """Returns settings from command line."""
+
+        parser = argparse.ArgumentParser(
+            description="Benchmark training throughput with XLA and mixed precision"
+        )
+        parser.add_argument(
+            "architecture",
+            metavar="a",
+            type=str,
+            nargs="?",
+            default="TFT",
+            choices=["LSTM", "TFT"],
+            help="Model architecture.",
+        )
+        parser.add_argument(
+            "features_file_path",
+            metavar="f",
+            type=str,
+            nargs="?",
+            default=os.path.join("data", "quandl_cpd_nonelbw_tsmom_full_top2.csv"),
+            help="Features file.",
+        )
+        parser.add_argument(
+            "time_steps",
+            metavar="l",
+            type=int,
+            nargs="?",
+            default=63,
+            help="Number of time steps per sequence.",
+        )
+        parser.add_argument(
+            "epochs",
+            metavar="e",
+            type=int,
+            nargs="?",
+            default=3,
+            help="Number of timed epochs.",
+        )
+
+        args = parser.parse_known_args()[0]
+
+        return (
+            args.architecture,
+            args.features_file_path,
+            args.time_steps,
+            args.epochs,
+        )
+
+    main(*get_args())
@@ -10,9 +10,10 @@ import copy
 
 import json
 
-from mom_trans.model_inputs import ModelFeatures
+from mom_trans.model_inputs import ModelFeatures, WindowedPanel
 from mom_trans.deep_momentum_network import LstmDeepMomentumNetworkModel, TransformerDeepMomentumNetworkModel
 from mom_trans.momentum_transformer import TftDeepMomentumNetworkModel
+from mom_trans.model_export import export_model
 from mom_trans.classical_strategies import (
     VOL_TARGET,
     calc_performance_metrics,
@@ -369,6 +370,66 @@ def aggregate_and_save_all_windows(
         file.write(json.dumps(list_metrics, indent=4))
 
 
+def _load_features(features_file_path: str) -> pd.DataFrame:
+    """Load the features file
+
+    Args:
+        features_file_path (str): name of file, containing features
+
+    Returns:
+        pd.DataFrame: features, indexed by date
+    """
+    print('load data')
+    raw_data = pd.read_csv(features_file_path, index_col=0, parse_dates=True)
+    raw_data["date"] = raw_data["date"].astype("datetime64[ns]")
+    raw_data["ticker"] = raw_data["ticker"].astype('str')
+    return raw_data
+
+
+def _add_ticker_as_static(params: dict) -> bool:
+    return (params["architecture"] == "TFT") or (params["architecture"] == "Transformer")
+
+
+def _resume_window(directory: str, search_params: dict, skip_if_completed: bool):
+    """Whether an interrupted window can resume its search and best model, which
+    requires the same parameters. Otherwise removes them and saves the new
+    parameters.
+
+    Args:
+        directory (str): directory of the window
+        search_params (dict): parameters of the search and the model
+        skip_if_completed (bool): False for a deliberate rerun, which never resumes
+
+    Returns:
+        bool: whether to resume
+    """
+    params_path = os.path.join(directory, "search_params.json")
+    # as loaded back from json
+    search_params = json.loads(json.dumps(search_params, default=str))
+    if os.path.exists(params_path):
+        with open(params_path) as file:
+            if skip_if_completed and json.load(file) == search_params:
+                return True
+
+    for name in ["hp", "best"]:
+        if os.path.exists(os.path.join(directory, name)):
+            print(f"Removing {name} of a previous run of the window.")
+            shutil.rmtree(os.path.join(directory, name))
+    os.makedirs(directory, exist_ok=True)
+    with open(params_path, "w") as file:
+        file.write(json.dumps(search_params, indent=4))
+    return False
+
+
+def _check_warm_start(params: dict, share_windows: bool):
+    """The warm start weights include the ticker embeddings, so the tickers must
+    be encoded the same in every window, as they are with a shared WindowedPanel."""
+    if _add_ticker_as_static(params) and not share_windows:
+        raise ValueError(
+            f"Warm start of the {params['architecture']} requires share_windows."
+        )
+
+
 def run_single_window(
     experiment_name: str,
     features_file_path: str,
@@ -378,6 +439,8 @@ def run_single_window(
     skip_if_completed: bool = True,
     asset_class_dictionary: Dict[str, str] = None,
     hp_minibatch_size: List[int] = HP_MINIBATCH_SIZE,
+    windowed_panel: WindowedPanel = None,
+    warm_start_directory: str = None,
 ):
     """Backtest for a single test window
 
@@ -390,6 +453,8 @@ def run_single_window(
         skip_if_completed (bool, optional): skip, if previously completed. Defaults to True.
         asset_class_dictionary (Dict[str, str], optional): map tickers to asset class. Defaults to None.
         hp_minibatch_size (List[int], optional): minibatch size hyperparameter grid. Defaults to HP_MINIBATCH_SIZE.
+        windowed_panel (WindowedPanel, optional): windows shared across all intervals, if None the features file is windowed for this interval only. Defaults to None.
+        warm_start_directory (str, optional): directory of a previous window, to initialise the model from its best weights. Defaults to None.
 
     Raises:
         Exception: [description]
@@ -402,28 +467,77 @@ def run_single_window(
         )
         return
 
-    print('load data')
-    raw_data = pd.read_csv(features_file_path, index_col=0, parse_dates=True)
-    raw_data["date"] = raw_data["date"].astype("datetime64[ns]")
-    raw_data["ticker"] = raw_data["ticker"].astype('str')
+    if windowed_panel:
+        raw_data = windowed_panel.data
+        model_features = ModelFeatures.from_windowed_panel(
+            windowed_panel,
+            start_boundary=train_interval[0],
+            test_boundary=train_interval[1],
+            test_end=train_interval[2],
+        )
+    else:
+        raw_data = _load_features(features_file_path)
+
+        # TODO more/less than the one year test buffer
+        model_features = ModelFeatures(
+            raw_data,
+            params["total_time_steps"],
+            start_boundary=train_interval[0],
+            test_boundary=train_interval[1],
+            test_end=train_interval[2],
+            changepoint_lbws=changepoint_lbws,
+            split_tickers_individually=params["split_tickers_individually"],
+            train_valid_ratio=params["train_valid_ratio"],
+            add_ticker_as_static=_add_ticker_as_static(params),
+            time_features=params["time_features"],
+            lags=params["force_output_sharpe_length"],
+            asset_class_dictionary=asset_class_dictionary,
+            storage_dtype=params.get("storage_dtype", "float32"),
+            n_batching_workers=params.get("batching_workers", 1),
+        )
 
-    # TODO more/less than the one year test buffer
-    model_features = ModelFeatures(
-        raw_data,
-        params["total_time_steps"],
-        start_boundary=train_interval[0],
-        test_boundary=train_interval[1],
-        test_end=train_interval[2],
-        changepoint_lbws=changepoint_lbws,
-        split_tickers_individually=params["split_tickers_individually"],
-        train_valid_ratio=params["train_valid_ratio"],
-        add_ticker_as_static=((params["architecture"] == "TFT") or (params["architecture"] == "Transformer")),
-        time_features=params["time_features"],
-        lags=params["force_output_sharpe_length"],
-        asset_class_dictionary=asset_class_dictionary,
+    hp_directory = os.path.join(directory, "hp")
+    best_directory = os.path.join(directory, "best")
+    resume = _resume_window(
+        directory,
+        dict(
+            **params,
+            **model_features.input_params,
+            changepoint_lbws=changepoint_lbws,
+            hp_minibatch_size=hp_minibatch_size,
+            warm_start_directory=warm_start_directory,
+        ),
+        skip_if_completed,
     )
 
-    hp_directory = os.path.join(directory, "hp")
+    warm_start_params = {}
+    warm_start_hp = None
+    if warm_start_directory and os.path.exists(
+        os.path.join(warm_start_directory, "best", "hyperparameters.json")
+    ):
+        _check_warm_start(params, windowed_panel is not None)
+        previous_params_path = os.path.join(warm_start_directory, "search_params.json")
+        if os.path.exists(previous_params_path):
+            with open(previous_params_path) as file:
+                previous_params = json.load(file)
+            # recomputed blocks are sub-models, with a different weight layout
+            if previous_params.get("recompute_gradients", False) != params.get(
+                "recompute_gradients", False
+            ):
+                raise ValueError(
+                    "Cannot warm start across a change of recompute_gradients."
+                )
+        print(f"Warm starting from {warm_start_directory}")
+        with open(
+            os.path.join(warm_start_directory, "best", "hyperparameters.json")
+        ) as file:
+            previous_hp = json.load(file)
+        warm_start_params["warm_start_weights"] = os.path.join(
+            warm_start_directory, "best", "checkpoint"
+        )
+        warm_start_params["warm_start_hyperparameters"] = previous_hp
+        if params.get("warm_start_reuse_hyperparameters", False):
+            warm_start_hp = previous_hp
 
     if params["architecture"] == "LSTM":
         dmn = LstmDeepMomentumNetworkModel(
@@ -432,6 +546,7 @@ def run_single_window(
             hp_minibatch_size,
             **params,
             **model_features.input_params,
+            **warm_start_params,
         )
     elif params["architecture"] == "TFT":
         dmn = TftDeepMomentumNetworkModel(
@@ -446,6 +561,7 @@ def run_single_window(
                 "stack_size": 1,
                 "num_heads": 4,  # TODO to fixed params
             },
+            **warm_start_params,
         )
     elif params["architecture"] == "Transformer":
         dmn = TransformerDeepMomentumNetworkModel(
@@ -454,14 +570,35 @@ def run_single_window(
             hp_minibatch_size,
             **params,
             **model_features.input_params,
+            **warm_start_params,
         )
     else:
         dmn = None
         raise Exception(f"{params['architecture']} is not a valid architecture.")
 
-    best_hp, best_model = dmn.hyperparameter_search(
-        model_features.train, model_features.valid
-    )
+    if resume and os.path.exists(os.path.join(best_directory, "hyperparameters.json")):
+        # the search finished before the window was interrupted
+        print("Resuming from the completed hyperparameter search.")
+        with open(os.path.join(best_directory, "hyperparameters.json")) as file:
+            best_hp = json.load(file)
+        best_model = dmn.load_model(best_hp)
+        best_model.load_weights(os.path.join(best_directory, "checkpoint"))
+    elif warm_start_hp:
+        # reuse the previous window's hyperparameters rather than searching
+        best_hp = warm_start_hp
+        temp_folder = os.path.join(hp_directory, "warm_start")
+        os.makedirs(temp_folder, exist_ok=True)
+        best_model = dmn.fit(
+            model_features.train,
+            model_features.valid,
+            best_hp,
+            os.path.join(temp_folder, "checkpoint"),
+        )
+    else:
+        # completed trials are reloaded from hp_directory if interrupted
+        best_hp, best_model = dmn.hyperparameter_search(
+            model_features.train, model_features.valid
+        )
     val_loss = dmn.evaluate(model_features.valid, best_model)
 
     print(f"Best validation loss = {val_loss}")
@@ -471,13 +608,29 @@ def run_single_window(
 
     with open(os.path.join(directory, "best_hyperparameters.json"), "w") as file:
         file.write(json.dumps(best_hp))
-    
-    best_directory = os.path.join(directory, "best")
+
+    if dmn.profiler:
+        profile = dmn.profiler.save(directory)
+        print(
+            f"Training profile: {profile['epochs']} epochs in {profile['time']:.0f}s, "
+            f"{profile['samples_per_sec']:.0f} samples/sec, "
+            f"process peak RSS {profile['process_peak_rss_mb']:.0f}MB"
+        )
+
     # best_model.save_weights(os.path.join(best_directory, "checkpoints", "checkpoint"))
     best_model.save_weights(os.path.join(best_directory, "checkpoint"))
+    # written last, marks the search as completed
     with open(os.path.join(best_directory, "hyperparameters.json"), "w") as file:
         file.write(json.dumps(best_hp, indent=4))
-    shutil.rmtree(hp_directory)
+
+    if params.get("export_model", False):
+        print("Exporting model...")
+        export_model(
+            best_model,
+            os.path.join(best_directory, "export"),
+            model_features.test_sliding["inputs"][: best_hp["batch_size"]],
+            quantisation=params.get("export_quantisation"),
+        )
 
     # if predict_on_test_set:
     print("Predicting on test set...")
@@ -539,13 +692,15 @@ def run_single_window(
             )
         )
         
-#     attention_weights = dmn.get_attention(model_features.test_sliding, best_hp["batch_size"])
-#     print(attention_weights['historical_flags'])
-#     pd.DataFrame(attention_weights['decoder_self_attn']).to_csv(os.path.join(directory,'attention_weights.csv'))
-#     pd.DataFrame.from_dict(attention_weights, orient = 'index').to_csv(os.path.join(directory,'attention_weights.csv'))
-#     with open(os.path.join(directory, "attention_weights.json"), "w") as file:
-#         file.write(json.dumps(attention_weights, indent = 4))
-        
+    if params.get("save_attention", False) and params["architecture"] == "TFT":
+        # written to memory mapped .npy files, as the sliding window attention
+        # weights of the full test set do not fit in memory
+        dmn.get_attention(
+            model_features.test_sliding,
+            best_hp["batch_size"],
+            directory=os.path.join(directory, "attention"),
+        )
+
     # save model and get rid of the hp dir
     # best_directory = os.path.join(directory, "best")
     # # best_model.save_weights(os.path.join(best_directory, "checkpoints", "checkpoint"))
@@ -567,6 +722,9 @@ def run_single_window(
             # "val_accuracy": val_accuracy,
         },
     )
+    # only once the results are written, so an interrupted window can resume
+    if os.path.exists(hp_directory):
+        shutil.rmtree(hp_directory)
 
     # get rid of everything and reset - TODO maybe not needed...
     del best_model
@@ -599,7 +757,27 @@ def run_all_windows(
         hp_minibatch_size ([type], optional): minibatch size hyperparameter grid. Defaults to HP_MINIBATCH_SIZE.
         standard_window_size (int, optional): standard number of years in test window. Defaults to 1.
     """
+    if params.get("warm_start", False):
+        _check_warm_start(params, params.get("share_windows", False))
+
+    windowed_panel = None
+    if params.get("share_windows", False):
+        if params["force_output_sharpe_length"]:
+            raise ValueError(
+                "share_windows is not supported with force_output_sharpe_length."
+            )
+        windowed_panel = WindowedPanel(
+            _load_features(features_file_path),
+            params["total_time_steps"],
+            train_valid_ratio=params["train_valid_ratio"],
+            split_tickers_individually=params["split_tickers_individually"],
+            add_ticker_as_static=_add_ticker_as_static(params),
+            asset_class_dictionary=asset_class_dictionary,
+            storage_dtype=params.get("storage_dtype", "float32"),
+        )
+
     # run the expanding window
+    warm_start_directory = None
     for interval in train_intervals:
         print(interval)
         run_single_window(
@@ -610,7 +788,11 @@ def run_all_windows(
             changepoint_lbws,
             asset_class_dictionary=asset_class_dictionary,
             hp_minibatch_size=hp_minibatch_size,
+            windowed_panel=windowed_panel,
+            warm_start_directory=warm_start_directory,
         )
+        if params.get("warm_start", False):
+            warm_start_directory = _get_directory_name(experiment_name, interval)
 
     aggregate_and_save_all_windows(
         experiment_name, train_intervals, asset_class_dictionary, standard_window_size
@@ -0,0 +1,227 @@
+"""Blockwise causal self-attention. chunked_causal_attention uses an online
+softmax, so that memory is linear in the number of time steps rather than
+quadratic: only blocks of chunk_size queries by chunk_size keys are
+materialised, one at a time, in the forward pass and in the gradient, which
+recomputes them from the saved log-sum-exp. blocked_causal_attention only skips
+the masked blocks, for speed rather than memory."""
+import numpy as np
+import tensorflow as tf
+
+from mom_trans.sequence_constants import causal_attention_bias
+
+
+def _chunk_bounds(time_steps: int, chunk_size: int):
+    return [
+        (start, min(start + chunk_size, time_steps))
+        for start in range(0, time_steps, chunk_size)
+    ]
+
+
+def _to_chunks(x, time_steps: int, chunk_size: int):
+    """Returns x of shape=(..., T, d) as chunks of shape=(num_chunks, ?,
+    chunk_size, d), with T zero padded to a multiple of chunk_size."""
+    num_chunks = -(-time_steps // chunk_size)
+    depth = x.shape[-1]
+    x = tf.reshape(x, [-1, time_steps, depth])
+    x = tf.pad(x, [[0, 0], [0, num_chunks * chunk_size - time_steps], [0, 0]])
+    x = tf.reshape(x, [-1, num_chunks, chunk_size, depth])
+    return tf.transpose(x, [1, 0, 2, 3])
+
+
+def _from_chunks(x, leading_shape, time_steps: int):
+    """Inverse of _to_chunks, for leading dimensions leading_shape."""
+    num_chunks, _, chunk_size, depth = x.shape
+    x = tf.reshape(tf.transpose(x, [1, 0, 2, 3]), [-1, num_chunks * chunk_size, depth])
+    return tf.reshape(
+        x[:, :time_steps], tf.concat([leading_shape, [time_steps, depth]], axis=0)
+    )
+
+
+def chunked_causal_attention(
+    qs, ks, vs, chunk_size: int, dropout_rate: float = 0.0, training=False
+):
+    """Applies causal scaled dot product attention, chunk_size steps at a time.
+    Equivalent to softmax(qs ks^T / sqrt(d_k) + causal mask) vs, with dropout on
+    the attention weights when training.
+
+    Args:
+        qs: Queries of shape=(..., T, d_k)
+        ks: Keys of shape=(..., T, d_k)
+        vs: Values of shape=(..., T, d_v), with the same leading dimensions
+        chunk_size: Number of query and key steps per block
+        dropout_rate: Dropout rate of the attention weights
+        training: Whether to apply dropout
+
+    Returns:
+        Attention outputs of shape=(..., T, d_v), with the dtype of qs
+    """
+    time_steps = qs.shape[-2]
+    if time_steps is None or ks.shape[-2] != time_steps:
+        raise ValueError(
+            "Chunked causal attention requires the same, fixed number of query "
+            "and key steps."
+        )
+    dtype = qs.dtype
+    scale = 1.0 / np.sqrt(qs.shape[-1])
+    num_chunks = -(-time_steps // chunk_size)
+    # only diagonal blocks are partly masked
+    diagonal_bias = causal_attention_bias(chunk_size, chunk_size)
+    use_dropout = bool(training) and dropout_rate > 0.0
+    seed = (
+        tf.random.uniform([2], maxval=2 ** 31 - 1, dtype=tf.int32)
+        if use_dropout
+        else None
+    )
+
+    def block_logits(q_i, k_j, i, j):
+        logits = tf.matmul(q_i, k_j, transpose_b=True) * scale
+        return logits + diagonal_bias * tf.cast(tf.equal(i, j), tf.float32)
+
+    def dropout_keep(weights, i, j):
+        """Returns the (deterministic) dropout keep mask of block (i, j), so that
+        the forward pass and the gradient drop the same attention weights."""
+        block_seed = seed + tf.stack([0, i * num_chunks + j])
+        keep = tf.random.stateless_uniform(tf.shape(weights), block_seed)
+        return tf.cast(keep >= dropout_rate, tf.float32) / (1.0 - dropout_rate)
+
+    def over_chunks(fn, num_outputs):
+        # one chunk at a time, so that only one block is held in memory
+        return tf.map_fn(
+            fn,
+            tf.range(num_chunks),
+            fn_output_signature=(tf.float32,) * num_outputs,
+            parallel_iterations=1,
+        )
+
+    @tf.custom_gradient
+    def attention(q, k, v):
+        def query_chunk(i):
+            q_i = q[i]
+
+            def key_chunk(j, running_max, normaliser, accumulated):
+                logits = block_logits(q_i, k[j], i, j)
+                new_max = tf.maximum(
+                    running_max, tf.reduce_max(logits, axis=-1, keepdims=True)
+                )
+                weights = tf.exp(logits - new_max)
+                correction = tf.exp(running_max - new_max)
+                normaliser = normaliser * correction + tf.reduce_sum(
+                    weights, axis=-1, keepdims=True
+                )
+                if use_dropout:
+                    weights *= dropout_keep(weights, i, j)
+                accumulated = accumulated * correction + tf.matmul(weights, v[j])
+                return j + 1, new_max, normaliser, accumulated
+
+            row_shape = tf.concat([tf.shape(q_i)[:-1], [1]], axis=0)
+            _, running_max, normaliser, accumulated = tf.while_loop(
+                lambda j, *_: j <= i,
+                key_chunk,
+                [
+                    tf.constant(0),
+                    tf.fill(row_shape, -np.inf),
+                    tf.zeros(row_shape),
+                    tf.zeros(tf.concat([row_shape[:-1], tf.shape(v)[-1:]], axis=0)),
+                ],
+            )
+            return accumulated / normaliser, running_max + tf.math.log(normaliser)
+
+        output, logsumexp = over_chunks(query_chunk, 2)
+
+        def grad(d_output):
+            # sum over keys of the weights times their gradient, per query
+            delta = tf.reduce_sum(d_output * output, axis=-1, keepdims=True)
+
+            def block_gradients(i, j):
+                """Returns the (dropped out) weights and the gradient of the
+                logits of block (i, j)."""
+                weights = tf.exp(block_logits(q[i], k[j], i, j) - logsumexp[i])
+                d_weights = tf.matmul(d_output[i], v[j], transpose_b=True)
+                dropped_weights = weights
+                if use_dropout:
+                    keep = dropout_keep(weights, i, j)
+                    dropped_weights = weights * keep
+                    d_weights *= keep
+                d_logits = weights * (d_weights - delta[i]) * scale
+                return dropped_weights, d_logits
+
+            def query_gradients(i):
+                def key_chunk(j, d_q):
+                    _, d_logits = block_gradients(i, j)
+                    return j + 1, d_q + tf.matmul(d_logits, k[j])
+
+                _, d_q = tf.while_loop(
+                    lambda j, _: j <= i,
+                    key_chunk,
+                    [tf.constant(0), tf.zeros_like(q[i])],
+                )
+                return (d_q,)
+
+            def key_value_gradients(j):
+                def query_chunk(i, d_k, d_v):
+                    dropped_weights, d_logits = block_gradients(i, j)
+                    d_k += tf.matmul(d_logits, q[i], transpose_a=True)
+                    d_v += tf.matmul(dropped_weights, d_output[i], transpose_a=True)
+                    return i + 1, d_k, d_v
+
+                _, d_k, d_v = tf.while_loop(
+                    lambda i, *_: i < num_chunks,
+                    query_chunk,
+                    [j, tf.zeros_like(k[j]), tf.zeros_like(v[j])],
+                )
+                return d_k, d_v
+
+            (d_q,) = over_chunks(query_gradients, 1)
+            d_k, d_v = over_chunks(key_value_gradients, 2)
+            return d_q, d_k, d_v
+
+        return output, grad
+
+    # accumulate in full precision under mixed precision
+    output = attention(
+        *[
+            _to_chunks(tf.cast(x, tf.float32), time_steps, chunk_size)
+            for x in [qs, ks, vs]
+        ]
+    )
+    output = _from_chunks(output, tf.shape(qs)[:-2], time_steps)
+    output.set_shape(qs.shape[:-1].concatenate(vs.shape[-1:]))
+    return tf.cast(output, dtype)
+
+
+def blocked_causal_attention(qs, ks, vs, block_size: int = 64, dropout=None):
+    """Applies causal scaled dot product attention to block_size query steps at
+    a time, each block attending only to the keys up to its last step, so that
+    most of the masked logits are never computed. The weights of each block are
+    materialised, so memory is still quadratic in T.
+
+    Args:
+        qs: Queries of shape=(..., T, d_k)
+        ks: Keys of shape=(..., T, d_k)
+        vs: Values of shape=(..., T, d_v), with the same leading dimensions
+        block_size: Number of query steps per block
+        dropout: Function to apply to the attention weights, if any
+
+    Returns:
+        Attention outputs of shape=(..., T, d_v)
+    """
+    time_steps = qs.shape[-2]
+    if time_steps is None or ks.shape[-2] != time_steps:
+        raise ValueError(
+            "Blocked causal attention requires the same, fixed number of query "
+            "and key steps."
+        )
+    # scaling the queries is cheaper than scaling the logits
+    qs /= np.sqrt(qs.shape[-1]).astype(qs.dtype.as_numpy_dtype)
+
+    outputs = []
+    for start, end in _chunk_bounds(time_steps, block_size):
+        logits = tf.matmul(qs[..., start:end, :], ks[..., :end, :], transpose_b=True)
+        weights = tf.nn.softmax(
+            logits + causal_attention_bias(end - start, end, logits.dtype)
+        )
+        if dropout is not None:
+            weights = dropout(weights)
+        outputs.append(tf.matmul(weights, vs[..., :end, :]))
+    return tf.concat(outputs, axis=-2)
+
@@ -3,6 +3,10 @@ import json
 import pathlib
 import shutil
 import copy
+import socket
+import multiprocessing
+import resource
+import time
 
 # from keras_tuner.tuners.randomsearch import RandomSearch
 from abc import ABC, abstractmethod
@@ -26,11 +30,89 @@ from settings.hp_grid import (
 from settings.fixed_params import MODLE_PARAMS
 
 from mom_trans.model_inputs import ModelFeatures
+from mom_trans.chunked_attention import (
+    blocked_causal_attention,
+    chunked_causal_attention,
+)
+from mom_trans.sequence_constants import position_encoding
 from empyrical import sharpe_ratio
 
 from keras_tuner.distribute import utils as ds_utils
 
 
+_SEARCH_DATA_KEYS = ["inputs", "outputs", "active_entries", "identifier", "date"]
+
+
+def _set_training_acceleration(jit_compile: bool, mixed_precision: bool):
+    """Sets XLA compilation and bfloat16 mixed precision for the models built
+    afterwards (both are global settings in tensorflow).
+
+    Args:
+        jit_compile (bool): compile the training graph with XLA
+        mixed_precision (bool): compute in bfloat16, keeping float32 variables
+    """
+    if jit_compile:
+        # auto-clustering only covers CPU ops with this flag, which is read once
+        os.environ.setdefault("TF_XLA_FLAGS", "--tf_xla_cpu_global_jit")
+    tf.config.optimizer.set_jit(jit_compile)
+    tf.keras.mixed_precision.experimental.set_policy(
+        "mixed_bfloat16" if mixed_precision else "float32"
+    )
+
+
+def _free_port():
+    """Finds a free port on localhost for the chief oracle."""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _save_data(data, directory):
+    """Saves the arrays used by the search as .npy files, so that search
+    processes can memory map them rather than each receiving a pickled copy."""
+    os.makedirs(directory, exist_ok=True)
+    for k in _SEARCH_DATA_KEYS:
+        np.save(os.path.join(directory, f"{k}.npy"), data[k], allow_pickle=True)
+
+
+def _load_data(directory):
+    data = {}
+    for k in _SEARCH_DATA_KEYS:
+        file_path = os.path.join(directory, f"{k}.npy")
+        try:
+            data[k] = np.load(file_path, mmap_mode="r")
+        except ValueError:  # object arrays cannot be memory mapped
+            data[k] = np.load(file_path, allow_pickle=True)
+    return data
+
+
+def _run_search_process(
+    tuner_id, port, num_threads, model_class, model_args, data_directory
+):
+    """Runs the chief oracle, or one search worker, of a parallel search."""
+    os.environ["KERASTUNER_TUNER_ID"] = tuner_id
+    os.environ["KERASTUNER_ORACLE_IP"] = "127.0.0.1"
+    os.environ["KERASTUNER_ORACLE_PORT"] = str(port)
+    tf.config.threading.set_intra_op_parallelism_threads(num_threads)
+    tf.config.threading.set_inter_op_parallelism_threads(num_threads)
+
+    project_name, hp_directory, hp_minibatch_size, params = model_args
+    dmn = model_class(project_name, hp_directory, hp_minibatch_size, **params)
+    if ds_utils.is_chief_oracle():
+        # the chief's tuner serves the oracle from its constructor, until the
+        # parent terminates it
+        return
+    dmn._search(
+        _load_data(os.path.join(data_directory, "train")),
+        _load_data(os.path.join(data_directory, "valid")),
+    )
+    if dmn.profiler:
+        # merged by the parent process
+        dmn.profiler.save_records(
+            os.path.join(dmn._profile_directory(), f"{tuner_id}.json")
+        )
+
+
 class SharpeLoss(tf.keras.losses.Loss):
     def __init__(self, output_size: int = 1):
         self.output_size = output_size  # in case we have multiple targets => output dim[-1] = output_size * n_quantiles
@@ -51,6 +133,9 @@ class SharpeLoss(tf.keras.losses.Loss):
 
 
 class SharpeValidationLoss(keras.callbacks.Callback):
+    # validation data shared (not copied) between the tuner's copies of the callback
+    _SHARED_ATTRIBUTES = ("inputs", "returns", "time_indices", "dataset")
+
     # TODO check if weights already exist and pass in best sharpe
     def __init__(
         self,
@@ -63,7 +148,8 @@ class SharpeValidationLoss(keras.callbacks.Callback):
         weights_save_location="tmp/checkpoint",
         # verbose=0,
         min_delta=1e-4,
-        transaction_costs = None
+        transaction_costs = None,
+        batch_size=256,
     ):
         super(keras.callbacks.Callback, self).__init__()
         self.inputs = inputs
@@ -73,83 +159,318 @@ class SharpeValidationLoss(keras.callbacks.Callback):
         self.early_stopping_patience = early_stopping_patience
         self.num_time = num_time
         self.min_delta = min_delta
+        self.batch_size = batch_size
 
         self.best_sharpe = np.NINF  # since calculating positive Sharpe...
-        # self.best_weights = None
+        self.best_weights = None
         self.weights_save_location = weights_save_location
         # self.verbose = verbose
         self.transaction_costs = transaction_costs
+        # batches of the in-memory arrays, built once for every fit
+        self.dataset = (
+            tf.data.Dataset.from_tensor_slices((inputs, returns, time_indices))
+            .batch(batch_size)
+            .prefetch(tf.data.experimental.AUTOTUNE)
+        )
+        self._validation_sharpe = None
 
     def set_weights_save_loc(self, weights_save_location):
         self.weights_save_location = weights_save_location
 
+    def save_best_weights(self):
+        """Writes the in-memory best weights to weights_save_location."""
+        if self.best_weights is not None:
+            weights = self.model.get_weights()
+            self.model.set_weights(self.best_weights)
+            self.model.save_weights(self.weights_save_location, save_format="h5")
+            self.model.set_weights(weights)
+
+    def __deepcopy__(self, memo):
+        """The tuner deep copies its callbacks for every execution, so share the
+        (read-only) validation arrays by reference rather than duplicating them."""
+        copied = self.__class__.__new__(self.__class__)
+        memo[id(self)] = copied
+        for k, v in self.__dict__.items():
+            if k in self._SHARED_ATTRIBUTES:
+                setattr(copied, k, v)
+            else:
+                setattr(copied, k, copy.deepcopy(v, memo))
+        return copied
+
     def on_train_begin(self, logs=None):
         self.patience_counter = 0
         self.stopped_epoch = 0
         self.best_sharpe = np.NINF
+        self.best_weights = None
+        # built per fit, as the callback must stay deep-copyable for the tuner
+        self._validation_sharpe = self._build_validation_sharpe()
+
+    def on_train_end(self, logs=None):
+        self._validation_sharpe = None
+        # only written to disk once per fit, for the tuner's checkpoint
+        self.save_best_weights()
+
+    def _build_validation_sharpe(self):
+        """Compiles the diversified validation Sharpe of the model into a single
+        tf.function, which runs over the validation dataset and only returns the
+        scalar Sharpe."""
+        dataset = self.dataset
+        model = self.model
+        num_time = self.num_time
+        transaction_costs = self.transaction_costs
+
+        @tf.function
+        def validation_sharpe():
+            returns_sum = tf.zeros([num_time], dtype=tf.float64)
+            returns_count = tf.zeros([num_time], dtype=tf.float64)
+            for inputs, returns, time_indices in dataset:
+                positions = tf.cast(model(inputs, training=False), tf.float64)
+                captured_returns = positions * tf.cast(returns, tf.float64)
+                if transaction_costs:
+                    abs_diff_position = tf.abs(positions[:, 1:] - positions[:, :-1])
+                    abs_diff_position = tf.where(
+                        tf.math.is_nan(abs_diff_position),
+                        tf.zeros_like(abs_diff_position),
+                        abs_diff_position,
+                    )
+                    abs_diff_position = tf.concat(
+                        [tf.zeros_like(positions[:, :1]), abs_diff_position], axis=1
+                    )
+                    captured_returns -= abs_diff_position * transaction_costs
+                returns_sum += tf.math.unsorted_segment_sum(
+                    captured_returns, time_indices, num_time
+                )
+                returns_count += tf.math.unsorted_segment_sum(
+                    tf.ones_like(captured_returns), time_indices, num_time
+                )
+            # mean over all tickers at each time, ignoring null times
+            captured_returns = tf.math.divide_no_nan(returns_sum, returns_count)[1:]
+            return (
+                tf.reduce_mean(captured_returns)
+                / tf.sqrt(
+                    tf.math.reduce_variance(captured_returns)
+                    + tf.constant(1e-9, dtype=tf.float64)
+                )
+                * tf.sqrt(tf.constant(252.0, dtype=tf.float64))
+            )
+
+        return validation_sharpe
 
     def on_epoch_end(self, epoch, logs=None):
-        positions = self.model.predict(
-            self.inputs,
-            workers=self.n_multiprocessing_workers,
-            use_multiprocessing=True,  # , batch_size=1
-        )
-        
-        if self.transaction_costs: 
-            diff_position = np.diff(positions, axis=1)
-            abs_diff_position = np.abs(diff_position)
-            abs_diff_position[np.isnan(abs_diff_position)] = 0.0
-            abs_diff_position = np.concatenate((np.expand_dims(np.zeros_like(positions[:, 0, 0]), axis  = (1,2)), abs_diff_position), axis=1)
-            
-            captured_returns = tf.math.unsorted_segment_mean(
-            positions * self.returns - abs_diff_position*self.transaction_costs, self.time_indices, self.num_time
-            )[1:]
-            # captured_returns = positions * self.returns - abs_diff_position*self.transaction_costs
-        else:
-            captured_returns = tf.math.unsorted_segment_mean(
-                positions * self.returns, self.time_indices, self.num_time
-            )[1:]
-            # captured_returns = positions*self.returns
-        # ignoring null times
-
-        # mean_returns = tf.reduce_mean(captured_returns)
-        # sharpe = (
-        #     mean_returns
-        #     / tf.sqrt(
-        #         tf.reduce_mean(tf.square(captured_returns))
-        #         - tf.square(mean_returns)
-        #         + tf.constant(1e-9, dtype=tf.float64)
-        #     )
-        #     * tf.sqrt(tf.constant(252.0, dtype=tf.float64))
-        # ).numpy()
-
-        # TODO sharpe
-        sharpe = (
-            tf.reduce_mean(captured_returns)
-            / tf.sqrt(
-                tf.math.reduce_variance(captured_returns)
-                + tf.constant(1e-9, dtype=tf.float64)
-            )
-            * tf.sqrt(tf.constant(252.0, dtype=tf.float64))
-        ).numpy()
+        sharpe = self._validation_sharpe().numpy()
         if sharpe > self.best_sharpe + self.min_delta:
             self.best_sharpe = sharpe
             self.patience_counter = 0  # reset the count
-            # self.best_weights = self.model.get_weights()
-            self.model.save_weights(self.weights_save_location, save_format="h5")
+            self.best_weights = self.model.get_weights()
         else:
             # if self.verbose: #TODO
             self.patience_counter += 1
             if self.patience_counter >= self.early_stopping_patience:
                 self.stopped_epoch = epoch
                 self.model.stop_training = True
-                self.model.load_weights(self.weights_save_location)
+                if self.best_weights is not None:
+                    self.model.set_weights(self.best_weights)
+                else:
+                    print("\nNo validation Sharpe improved, no best weights kept.")
         logs["sharpe"] = sharpe  # for keras tuner
         print(f"\nval_sharpe {logs['sharpe']}")
 
 
+class TrainingProfiler(keras.callbacks.Callback):
+    """Records the wall time, throughput and peak memory of every training epoch.
+
+    Should be the last callback, so that the validation time includes the
+    validation callbacks (e.g. SharpeValidationLoss) as well as Keras validation.
+    Records are shared between the tuner's copies of the callback. The peak
+    memory is that of the whole process so far, not of the epoch or trial.
+    """
+
+    def __init__(self, num_samples: int):
+        super().__init__()
+        self.num_samples = num_samples
+        self.trial_id = None
+        self.records = []
+        self._num_fits = [0]
+
+    def __deepcopy__(self, memo):
+        copied = copy.copy(self)
+        memo[id(self)] = copied
+        return copied
+
+    def set_trial(self, trial_id):
+        self.trial_id = trial_id
+
+    def on_train_begin(self, logs=None):
+        self._fit = self._num_fits[0]
+        self._num_fits[0] += 1
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self._epoch_start = time.time()
+        self._train_end = self._epoch_start
+        self._steps = 0
+
+    def on_train_batch_end(self, batch, logs=None):
+        self._steps += 1
+        self._train_end = time.time()
+
+    def on_epoch_end(self, epoch, logs=None):
+        epoch_end = time.time()
+        train_time = self._train_end - self._epoch_start
+        # no throughput if the epoch had no train batches
+        train_seconds = train_time if train_time > 0 else np.nan
+        self.records.append(
+            {
+                "trial": self.trial_id,
+                "fit": self._fit,
+                "epoch": epoch,
+                "epoch_time": epoch_end - self._epoch_start,
+                "train_time": train_time,
+                "validation_time": epoch_end - self._train_end,
+                "train_steps_per_sec": self._steps / train_seconds,
+                "samples_per_sec": self.num_samples / train_seconds,
+                # kilobytes on linux
+                "process_peak_rss_mb": resource.getrusage(
+                    resource.RUSAGE_SELF
+                ).ru_maxrss
+                / 1024,
+            }
+        )
+
+    def save_records(self, file_path: str):
+        """Writes the epoch records to json, e.g. from a search worker process."""
+        with open(file_path, "w") as file:
+            file.write(json.dumps(self.records, default=float))
+
+    def load_records(self, file_path: str):
+        """Appends the epoch records written by save_records."""
+        with open(file_path) as file:
+            self.records.extend(json.load(file))
+
+    def save(self, directory: str):
+        """Writes the epoch records to training_profile.csv and a summary, per
+        trial and for the window, to training_profile.json.
+
+        Args:
+            directory (str): directory to save to
+
+        Returns:
+            dict: summary of the window
+        """
+        profile = pd.DataFrame(
+            self.records,
+            columns=[
+                "trial",
+                "fit",
+                "epoch",
+                "epoch_time",
+                "train_time",
+                "validation_time",
+                "train_steps_per_sec",
+                "samples_per_sec",
+                "process_peak_rss_mb",
+            ],
+        )
+        profile.to_csv(os.path.join(directory, "training_profile.csv"), index=False)
+
+        trials = (
+            profile.fillna({"trial": "fit"})
+            .groupby("trial", sort=False)
+            .agg(
+                epochs=("epoch", "count"),
+                time=("epoch_time", "sum"),
+                validation_time=("validation_time", "sum"),
+                train_steps_per_sec=("train_steps_per_sec", "mean"),
+                samples_per_sec=("samples_per_sec", "mean"),
+                process_peak_rss_mb=("process_peak_rss_mb", "max"),
+            )
+        )
+        summary = {
+            "epochs": len(profile),
+            "time": profile["epoch_time"].sum(),
+            "validation_time": profile["validation_time"].sum(),
+            "train_steps_per_sec": profile["train_steps_per_sec"].mean(),
+            "samples_per_sec": profile["samples_per_sec"].mean(),
+            "process_peak_rss_mb": profile["process_peak_rss_mb"].max(),
+            "trials": trials.to_dict(orient="index"),
+        }
+        with open(os.path.join(directory, "training_profile.json"), "w") as file:
+            file.write(json.dumps(summary, indent=4, default=float))
+        return summary
+
+
+def _set_profiler_trial(callbacks, trial):
+    for callback in callbacks:
+        if isinstance(callback, TrainingProfiler):
+            callback.set_trial(trial.trial_id)
+
+
+class _ValidationLossTrial:
+    """Samples the minibatch size of each trial, for tuners with a Keras metric
+    objective."""
+
+    def run_trial(self, trial, *args, **kwargs):
+        kwargs["batch_size"] = trial.hyperparameters.Choice(
+            "batch_size", values=self.hp_minibatch_size
+        )
+        _set_profiler_trial(kwargs.get("callbacks", []), trial)
+        super().run_trial(trial, *args, **kwargs)
+
+
+class _DiversifiedSharpeTrial:
+    """Samples the minibatch size of each trial and reports the diversified
+    validation Sharpe, for tuners with the sharpe objective."""
+
+    def run_trial(self, trial, *args, **kwargs):
+        kwargs["batch_size"] = trial.hyperparameters.Choice(
+            "batch_size", values=self.hp_minibatch_size
+        )
+        hp_values = trial.hyperparameters.values
+        if "tuner/epochs" in hp_values:
+            # epoch budget allocated by Hyperband
+            kwargs["epochs"] = hp_values["tuner/epochs"]
+            kwargs["initial_epoch"] = hp_values["tuner/initial_epoch"]
+
+        original_callbacks = kwargs.pop("callbacks", [])
+        _set_profiler_trial(original_callbacks, trial)
+
+        for callback in original_callbacks:
+            if isinstance(callback, SharpeValidationLoss):
+                print(trial.trial_id)
+                # tf. mkdir(os.path.join(str(self.project_dir), "trial_" + str(trial.trial_id)))
+                callback.set_weights_save_loc(
+                    self._get_checkpoint_fname(trial.trial_id , self._reported_step)
+                )
+
+        # Run the training process multiple times.
+        metrics = collections.defaultdict(list)
+        for execution in range(self.executions_per_trial):
+            copied_fit_kwargs = copy.copy(kwargs)
+            callbacks = self._deepcopy_callbacks(original_callbacks)
+            self._configure_tensorboard_dir(callbacks, trial, execution)
+            callbacks.append(kt.engine.tuner_utils.TunerCallback(self, trial))
+            # Only checkpoint the best epoch across all executions.
+            # callbacks.append(model_checkpoint)
+            copied_fit_kwargs["callbacks"] = callbacks
+
+            history = self._build_and_fit_model(trial, args, copied_fit_kwargs)
+            for metric, epoch_values in history.history.items():
+                if self.oracle.objective.direction == "min":
+                    best_value = np.min(epoch_values)
+                else:
+                    best_value = np.max(epoch_values)
+                metrics[metric].append(best_value)
+
+        # Average the results across executions and send to the Oracle.
+        averaged_metrics = {}
+        for metric, execution_values in metrics.items():
+            averaged_metrics[metric] = np.mean(execution_values)
+        self.oracle.update_trial(
+            trial.trial_id, metrics=averaged_metrics, step=self._reported_step
+        )
+
+
 # Tuner = RandomSearch
-class TunerValidationLoss(kt.tuners.RandomSearch):
+class TunerValidationLoss(_ValidationLossTrial, kt.tuners.RandomSearch):
     def __init__(
         self,
         hypermodel,
@@ -174,14 +495,8 @@ class TunerValidationLoss(kt.tuners.RandomSearch):
             **kwargs,
         )
 
-    def run_trial(self, trial, *args, **kwargs):
-        kwargs["batch_size"] = trial.hyperparameters.Choice(
-            "batch_size", values=self.hp_minibatch_size
-        )
-        super(TunerValidationLoss, self).run_trial(trial, *args, **kwargs)
-
 
-class TunerDiversifiedSharpe(kt.tuners.RandomSearch):
+class TunerDiversifiedSharpe(_DiversifiedSharpeTrial, kt.tuners.RandomSearch):
     def __init__(
         self,
         hypermodel,
@@ -207,50 +522,71 @@ class TunerDiversifiedSharpe(kt.tuners.RandomSearch):
             **kwargs,
         )
 
-    def run_trial(self, trial, *args, **kwargs):
-        kwargs["batch_size"] = trial.hyperparameters.Choice(
-            "batch_size", values=self.hp_minibatch_size
-        )
-
-        original_callbacks = kwargs.pop("callbacks", [])
-
-        for callback in original_callbacks:
-            if isinstance(callback, SharpeValidationLoss):
-                print(trial.trial_id)
-                # tf. mkdir(os.path.join(str(self.project_dir), "trial_" + str(trial.trial_id)))
-                callback.set_weights_save_loc(
-                    self._get_checkpoint_fname(trial.trial_id , self._reported_step)
-                )
 
-        # Run the training process multiple times.
-        metrics = collections.defaultdict(list)
-        for execution in range(self.executions_per_trial):
-            copied_fit_kwargs = copy.copy(kwargs)
-            callbacks = self._deepcopy_callbacks(original_callbacks)
-            self._configure_tensorboard_dir(callbacks, trial, execution)
-            callbacks.append(kt.engine.tuner_utils.TunerCallback(self, trial))
-            # Only checkpoint the best epoch across all executions.
-            # callbacks.append(model_checkpoint)
-            copied_fit_kwargs["callbacks"] = callbacks
+class HyperbandValidationLoss(_ValidationLossTrial, kt.tuners.Hyperband):
+    def __init__(
+        self,
+        hypermodel,
+        objective,
+        max_epochs,
+        hp_minibatch_size,
+        factor=3,
+        hyperband_iterations=1,
+        seed=None,
+        hyperparameters=None,
+        tune_new_entries=True,
+        allow_new_entries=True,
+        **kwargs,
+    ):
+        self.hp_minibatch_size = hp_minibatch_size
+        super().__init__(
+            hypermodel,
+            objective,
+            max_epochs,
+            factor,
+            hyperband_iterations,
+            seed,
+            hyperparameters,
+            tune_new_entries,
+            allow_new_entries,
+            **kwargs,
+        )
 
-            history = self._build_and_fit_model(trial, args, copied_fit_kwargs)
-            for metric, epoch_values in history.history.items():
-                if self.oracle.objective.direction == "min":
-                    best_value = np.min(epoch_values)
-                else:
-                    best_value = np.max(epoch_values)
-                metrics[metric].append(best_value)
 
-        # Average the results across executions and send to the Oracle.
-        averaged_metrics = {}
-        for metric, execution_values in metrics.items():
-            averaged_metrics[metric] = np.mean(execution_values)
-        self.oracle.update_trial(
-            trial.trial_id, metrics=averaged_metrics, step=self._reported_step
+class HyperbandDiversifiedSharpe(_DiversifiedSharpeTrial, kt.tuners.Hyperband):
+    def __init__(
+        self,
+        hypermodel,
+        objective,
+        max_epochs,
+        hp_minibatch_size,
+        factor=3,
+        hyperband_iterations=1,
+        seed=None,
+        hyperparameters=None,
+        tune_new_entries=True,
+        allow_new_entries=True,
+        **kwargs,
+    ):
+        self.hp_minibatch_size = hp_minibatch_size
+        super().__init__(
+            hypermodel,
+            objective,
+            max_epochs,
+            factor,
+            hyperband_iterations,
+            seed,
+            hyperparameters,
+            tune_new_entries,
+            allow_new_entries,
+            **kwargs,
         )
 
 
 class DeepMomentumNetworkModel(ABC):
+    # hyperparameters that determine the weight shapes
+    ARCHITECTURE_HYPERPARAMETERS = ["hidden_layer_size"]
+
     def __init__(self, project_name, hp_directory, hp_minibatch_size, **params):
         params = params.copy()
 
@@ -262,9 +598,35 @@ class DeepMomentumNetworkModel(ABC):
         self.early_stopping_patience = int(params["early_stopping_patience"])
         # self.sliding_window = params["sliding_window"]
         self.random_search_iterations = params["random_search_iterations"]
+        self.tuner_type = params.get("tuner", "random_search")
+        self.hyperband_factor = int(params.get("hyperband_factor", 3))
+        self.hyperband_iterations = int(params.get("hyperband_iterations", 1))
         self.evaluate_diversified_val_sharpe = params["evaluate_diversified_val_sharpe"]
         self.force_output_sharpe_length = params["force_output_sharpe_length"]
         self.transaction_costs = params["transaction_costs"]
+        self.n_parallel_trials = int(params.get("parallel_trials", 1))
+        self.profile_training = params.get("profile_training", False)
+        self.profiler = None
+        # sliding window predictions only from the final step, where supported
+        self.last_step_inference = params.get("last_step_inference", True)
+        self._last_step_model = None  # (full model, last step model)
+        # causal attention chunk_size steps at a time, with memory linear in T
+        self.attention_chunk_size = params.get("attention_chunk_size")
+        _set_training_acceleration(
+            params.get("jit_compile", False), params.get("mixed_precision", False)
+        )
+        # initialise from the weights of a previous (expanding) window
+        self.warm_start_weights = params.get("warm_start_weights")
+        hyperparameters = None
+        if self.warm_start_weights:
+            self.num_epochs = int(params["warm_start_epochs"])
+            # the weights only fit models with the previous window's architecture
+            hyperparameters = kt.HyperParameters()
+            for name in self.ARCHITECTURE_HYPERPARAMETERS:
+                hyperparameters.Fixed(name, params["warm_start_hyperparameters"][name])
+        self._time_indices_cache = None
+        # to rebuild the model in parallel search processes
+        self._model_args = (project_name, hp_directory, hp_minibatch_size, params)
 
         print("Deep Momentum Network params:")
         for k in params:
@@ -272,46 +634,179 @@ class DeepMomentumNetworkModel(ABC):
 
         # To build model
         def model_builder(hp):
-            return self.model_builder(hp)
+            model = self.model_builder(hp)
+            if self.warm_start_weights:
+                self._load_warm_start_weights(model)
+            return model
 
         if self.evaluate_diversified_val_sharpe:
-            self.tuner = TunerDiversifiedSharpe(
+            objective = kt.Objective("sharpe", "max")
+        else:
+            # objective="val_loss",
+            objective = "val_accuracy"
+
+        if self.tuner_type == "random_search":
+            tuner_class = (
+                TunerDiversifiedSharpe
+                if self.evaluate_diversified_val_sharpe
+                else TunerValidationLoss
+            )
+            self.tuner = tuner_class(
                 model_builder,
-                objective=kt.Objective("sharpe", "max"),
+                objective=objective,
                 hp_minibatch_size=hp_minibatch_size,
                 max_trials=self.random_search_iterations,
+                hyperparameters=hyperparameters,
                 directory=hp_directory,
                 project_name=project_name,
             )
-        else:
-            self.tuner = TunerValidationLoss(
+        elif self.tuner_type == "hyperband":
+            tuner_class = (
+                HyperbandDiversifiedSharpe
+                if self.evaluate_diversified_val_sharpe
+                else HyperbandValidationLoss
+            )
+            self.tuner = tuner_class(
                 model_builder,
-                # objective="val_loss",
-                objective = "val_accuracy",
+                objective=objective,
+                max_epochs=self.num_epochs,
                 hp_minibatch_size=hp_minibatch_size,
-                max_trials=self.random_search_iterations,
+                factor=self.hyperband_factor,
+                hyperband_iterations=self.hyperband_iterations,
+                hyperparameters=hyperparameters,
                 directory=hp_directory,
                 project_name=project_name,
             )
+        else:
+            raise ValueError(f"{self.tuner_type} is not a valid tuner.")
 
     @abstractmethod
     def model_builder(self, hp):
         return
 
+    def _load_warm_start_weights(self, model):
+        """Initialises the model from the warm start weights, which must have a
+        value for every weight of the model."""
+        try:
+            model.load_weights(self.warm_start_weights).assert_existing_objects_matched()
+        except (ValueError, AssertionError) as error:
+            raise ValueError(
+                f"Warm start weights {self.warm_start_weights} do not match the "
+                f"model: {error}"
+            ) from error
+
     @staticmethod
     def _index_times(val_time):
-        val_time_unique = np.sort(np.unique(val_time))
-        if val_time_unique[0]:  # check if ""
-            val_time_unique = np.insert(val_time_unique, 0, "")
-        mapping = dict(zip(val_time_unique, range(len(val_time_unique))))
+        """Maps each validation time to an integer index, with 0 reserved for
+        the blank (padded) times.
 
-        @np.vectorize
-        def get_indices(t):
-            return mapping[t]
+        Args:
+            val_time (np.array): array of dates, formatted as %Y-%m-%d, or ""
 
-        return get_indices(val_time), len(mapping)
+        Returns:
+            Tuple[np.array, int]: time indices, with the same shape as val_time,
+            and the number of distinct indices (including the blank index)
+        """
+        # blanks are parsed as NaT, which is encoded as the smallest integer
+        encoded_time = (
+            pd.to_datetime(val_time.ravel(), format="%Y-%m-%d", errors="coerce")
+            .values.view("i8")
+        )
+        val_time_unique, indices = np.unique(encoded_time, return_inverse=True)
+        if val_time_unique[0] != np.iinfo("i8").min:  # check if ""
+            indices += 1
+        num_time = indices.max() + 1 if indices.size else 1
+        return indices.reshape(val_time.shape), int(num_time)
+
+    def _cached_index_times(self, val_time):
+        """Indexes the validation times, only once for each validation dataset."""
+        if (
+            self._time_indices_cache is None
+            or self._time_indices_cache[0] is not val_time
+        ):
+            self._time_indices_cache = (val_time, self._index_times(val_time))
+        return self._time_indices_cache[1]
 
     def hyperparameter_search(self, train_data, valid_data):
+        if self.n_parallel_trials > 1:
+            self._parallel_search(train_data, valid_data)
+        else:
+            self._search(train_data, valid_data)
+
+        best_hp = self.tuner.get_best_hyperparameters(num_trials=1)[0].values
+        best_model = self.tuner.get_best_models(num_models=1)[0]
+        return best_hp, best_model
+
+    def _parallel_search(self, train_data, valid_data):
+        """Runs n_parallel_trials trials at a time, each in a worker process with
+        its share of the CPU threads, against a chief oracle on localhost."""
+        data_directory = os.path.join(str(self.tuner.project_dir), "search_data")
+        _save_data(train_data, os.path.join(data_directory, "train"))
+        _save_data(valid_data, os.path.join(data_directory, "valid"))
+        profile_directory = self._profile_directory()
+        if self.profile_training:
+            shutil.rmtree(profile_directory, ignore_errors=True)
+            os.makedirs(profile_directory)
+
+        port = _free_port()
+        num_threads = max(1, multiprocessing.cpu_count() // self.n_parallel_trials)
+        # tensorflow is not fork safe
+        context = multiprocessing.get_context("spawn")
+
+        def search_process(tuner_id):
+            return context.Process(
+                target=_run_search_process,
+                args=(
+                    tuner_id,
+                    port,
+                    num_threads,
+                    self.__class__,
+                    self._model_args,
+                    data_directory,
+                ),
+            )
+
+        chief = search_process("chief")
+        chief.start()
+        workers = [search_process(f"tuner{i}") for i in range(self.n_parallel_trials)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        # the oracle state is saved after each trial, so the chief can be
+        # terminated as soon as the workers are done
+        chief.terminate()
+        chief.join()
+        shutil.rmtree(data_directory)
+
+        if any(worker.exitcode for worker in workers):
+            raise RuntimeError("Parallel hyperparameter search worker failed.")
+
+        if self.profile_training:
+            # the trials were profiled in the worker processes
+            if self.profiler is None:
+                self.profiler = TrainingProfiler(len(train_data["inputs"]))
+            for file_name in sorted(os.listdir(profile_directory)):
+                self.profiler.load_records(os.path.join(profile_directory, file_name))
+            shutil.rmtree(profile_directory)
+
+        self.tuner.reload()
+
+    def _profile_directory(self):
+        """Directory of the training profiles of the parallel search workers."""
+        return os.path.join(str(self.tuner.project_dir), "training_profiles")
+
+    def _add_profiler(self, callbacks, num_samples):
+        """Appends the training profiler, last so that it also times the
+        validation callbacks."""
+        if self.profile_training:
+            if self.profiler is None:
+                self.profiler = TrainingProfiler(num_samples)
+            self.profiler.set_trial(None)
+            callbacks.append(self.profiler)
+        return callbacks
+
+    def _search(self, train_data, valid_data):
         data, labels, active_flags, _, _ = ModelFeatures._unpack(train_data)
         val_data, val_labels, val_flags, _, val_time = ModelFeatures._unpack(valid_data)
 
@@ -319,7 +814,7 @@ class DeepMomentumNetworkModel(ABC):
         # print(data.shape, labels.shape, val_data.shape)
 
         if self.evaluate_diversified_val_sharpe:
-            val_time_indices, num_val_time = self._index_times(val_time)
+            val_time_indices, num_val_time = self._cached_index_times(val_time)
             callbacks = [
                 SharpeValidationLoss(
                     val_data,
@@ -340,7 +835,7 @@ class DeepMomentumNetworkModel(ABC):
                 epochs=self.num_epochs,
                 # batch_size=minibatch_size,
                 # covered by Tuner class
-                callbacks=callbacks,
+                callbacks=self._add_profiler(callbacks, len(data)),
                 shuffle=True,
                 use_multiprocessing=True,
                 workers=self.n_multiprocessing_workers,
@@ -368,17 +863,13 @@ class DeepMomentumNetworkModel(ABC):
                     val_labels,
                     val_flags,
                 ),
-                callbacks=callbacks,
+                callbacks=self._add_profiler(callbacks, len(data)),
                 shuffle=True,
                 use_multiprocessing=True,
                 workers=self.n_multiprocessing_workers,
                 # validation_batch_size=1,
             )
 
-        best_hp = self.tuner.get_best_hyperparameters(num_trials=1)[0].values
-        best_model = self.tuner.get_best_models(num_models=1)[0]
-        return best_hp, best_model
-
     def load_model(
         self,
         hyperparameters,
@@ -400,7 +891,7 @@ class DeepMomentumNetworkModel(ABC):
         model = self.load_model(hyperparameters)
 
         if self.evaluate_diversified_val_sharpe:
-            val_time_indices, num_val_time = self._index_times(val_time)
+            val_time_indices, num_val_time = self._cached_index_times(val_time)
             callbacks = [
                 SharpeValidationLoss(
                     val_data,
@@ -421,7 +912,7 @@ class DeepMomentumNetworkModel(ABC):
                 sample_weight=active_flags,
                 epochs=self.num_epochs,
                 batch_size=hyperparameters["batch_size"],
-                callbacks=callbacks,
+                callbacks=self._add_profiler(callbacks, len(data)),
                 shuffle=True,
                 use_multiprocessing=True,
                 workers=self.n_multiprocessing_workers,
@@ -450,7 +941,7 @@ class DeepMomentumNetworkModel(ABC):
                     val_labels,
                     val_flags,
                 ),
-                callbacks=callbacks,
+                callbacks=self._add_profiler(callbacks, len(data)),
                 shuffle=True,
                 use_multiprocessing=True,
                 workers=self.n_multiprocessing_workers,
@@ -486,6 +977,13 @@ class DeepMomentumNetworkModel(ABC):
             metrics = pd.Series(metric_values, model.metrics_names)
             return metrics["loss"]
 
+    def _get_last_step_model(self, model):
+        """Returns the model sharing the weights of `model` that only predicts the
+        final time step, if one was built with it, otherwise `model` itself."""
+        if self._last_step_model is not None and self._last_step_model[0] is model:
+            return self._last_step_model[1]
+        return model
+
     def get_positions(
         self,
         data,
@@ -509,6 +1007,8 @@ class DeepMomentumNetworkModel(ABC):
             returns = outputs.flatten()
         mask = (years >= years_geq) & (years < years_lt)
 
+        if sliding_window and self.last_step_inference:
+            model = self._get_last_step_model(model)
         positions = model.predict(
             inputs,
             workers=self.n_multiprocessing_workers,
@@ -571,6 +1071,7 @@ class LstmDeepMomentumNetworkModel(DeepMomentumNetworkModel):
                 1,
                 activation="sigmoid",
                 kernel_constraint=keras.constraints.max_norm(3),
+                dtype="float32",  # outputs in full precision for the loss
             )
         )(dropout[..., :, :])
 
@@ -590,6 +1091,8 @@ class LstmDeepMomentumNetworkModel(DeepMomentumNetworkModel):
         return model
 
 class TransformerDeepMomentumNetworkModel(DeepMomentumNetworkModel):
+    ARCHITECTURE_HYPERPARAMETERS = ["dq", "no_heads", "no_layers", "ff_dim"]
+
     def __init__(self, project_name, hp_directory, hp_minibatch_size = [512, 1024], **params):
         params = params.copy()
         self.category_counts = params["category_counts"]
@@ -615,22 +1118,19 @@ class TransformerDeepMomentumNetworkModel(DeepMomentumNetworkModel):
         no_categories = self.category_counts
 
         inputs = keras.Input(shape = (time_steps, self.input_size))
+        num_regular_variables = self.input_size - len(no_categories)
 
-        x = keras.layers.TimeDistributed(keras.layers.Dense(d_q))(inputs) # output has shape (?, timesteps, d_q)
-        x = T2V(d_q)(x) ()
+        x = keras.layers.Dense(d_q)(inputs[..., :num_regular_variables]) # output has shape (?, timesteps, d_q)
 
-        # x = tf.keras.layers.Dense(d_q)(inputs)
-        
         # pos_enc = self.PositionEncoding(d_q)
 
-        ticker_enc, class_enc = self.AssetEmbedding(inputs, d_q)
-        x = tf.concat([x, tf.concat([ticker_enc, class_enc], axis = -1)], axis = -1)
-        # x = x + pos_enc + ticker_enc + class_enc
+        # time embedding is the same for every sample, asset embeddings for every step
+        x = Time2Vec()(x) + self.AssetEmbedding(inputs, d_q)
 
         def transformer_encoder(inputs, key_dim, num_heads, ff_dim, dropout=0):
             # Normalization and Attention
             x = tf.keras.layers.LayerNormalization(epsilon=1e-6)(inputs)
-            x = tf.keras.layers.MultiHeadAttention(key_dim=key_dim, num_heads=num_heads, dropout=dropout)(x, x, use_causal_mask = True)
+            x = CausalMultiHeadAttention(self.attention_chunk_size, key_dim=key_dim, num_heads=num_heads, dropout=dropout)(x, x)
             x = tf.keras.layers.Dropout(dropout)(x)
             res = x + inputs
 
@@ -654,54 +1154,51 @@ class TransformerDeepMomentumNetworkModel(DeepMomentumNetworkModel):
         
         outputs = tf.keras.layers.TimeDistributed(
             tf.keras.layers.Dense(
-                self.output_size, 
-                activation = tf.nn.softmax,
-                kernel_constraint = keras.constraints.max_norm(3),
-                ))(x[..., :, :])  # (batch_size, output_size)
+                # self.output_size,
+                1,
+                activation="sigmoid",
+                kernel_constraint=keras.constraints.max_norm(3),
+                dtype="float32",  # outputs in full precision for the loss
+            )
+        )(x[..., :, :])
 
         model = keras.Model(inputs= inputs, outputs=outputs)
 
         adam = keras.optimizers.Adam(lr=learning_rate, clipnorm=max_gradient_norm)
 
-        sharpe_loss = SharpeLoss(self.output_size).call
+        # sharpe_loss = SharpeLoss(self.output_size).call
 
         model.compile(
-            loss=sharpe_loss,
+            loss=tf.keras.losses.BinaryCrossentropy(from_logits=False),
             optimizer=adam,
             sample_weight_mode="temporal",
+            metrics = ["accuracy"],
+            weighted_metrics = []
         )
         return model
     
     def AssetEmbedding(self, all_inputs, d_model):
-        time_steps = self.time_steps
-        no_categories = self.category_counts
-
+        """Embeds the static categorical inputs (e.g. ticker and asset class).
+        Args:
+            all_inputs: Inputs of shape=(?, T, input_size), ending with the
+                categorical inputs
+            d_model: Embedding size
+        Returns:
+            Sum of the embeddings of the first step, of shape=(?, 1, d_model)
+            to broadcast over time
+        """
         num_categorical_variables = len(self.category_counts)
         num_regular_variables = self.input_size - num_categorical_variables
 
-        embedding_sizes = [d_model for _, _ in enumerate(self.category_counts)]
-
-        embeddings = []
-        for i in range(num_categorical_variables):
-
-            embedding = keras.Sequential(
-                [keras.layers.InputLayer([time_steps]),
-                    keras.layers.Embedding(
-                        self.category_counts[i],
-                        embedding_sizes[i],
-                        input_length=time_steps,
-                        dtype=tf.float32,
-                    ),])
-            embeddings.append(embedding)
-        categorical_inputs = all_inputs[:, :, num_regular_variables:]
-
-        embedded_inputs = [
-                embeddings[i](categorical_inputs[Ellipsis, i])
-                for i in range(num_categorical_variables)]
-
-        static_inputs= [embedded_inputs[i][:, :, :] for i in range(num_categorical_variables)]
-        # static_inputs = keras.backend.stack(embedded_inputs, axis = 2)
-        return static_inputs[0], static_inputs[1] 
+        # one table for all variables, with the categories of each offset
+        offsets = np.cumsum([0] + self.category_counts[:-1]).astype(np.int32)
+        categorical_inputs = (
+            tf.cast(all_inputs[:, :1, num_regular_variables:], tf.int32) + offsets
+        )
+        embedded_inputs = keras.layers.Embedding(
+            sum(self.category_counts), d_model, dtype=tf.float32
+        )(categorical_inputs)  # shape=(?, 1, num_categorical_variables, d_model)
+        return tf.reduce_sum(embedded_inputs, axis=-2)
     
     
     def get_embeddings(self, all_inputs):
@@ -758,14 +1255,68 @@ class TransformerDeepMomentumNetworkModel(DeepMomentumNetworkModel):
         return known_combined_layer
     
     def PositionEncoding(self, output_dim, n=10000):
-        # print(type(seq_len), type(output_dim))
-        P = np.zeros((self.time_steps, output_dim))
-        for k in range(self.time_steps):
-            for i in np.arange(int(output_dim/2)):
-                denominator = np.power(n, 2*i/output_dim)
-                P[k, 2*i] = np.sin(k/denominator)
-                P[k, 2*i+1] = np.cos(k/denominator)
-        return tf.convert_to_tensor(P, dtype=tf.float32)
+        return tf.convert_to_tensor(
+            position_encoding(self.time_steps, output_dim, n), dtype=tf.float32
+        )
+
+class CausalMultiHeadAttention(tf.keras.layers.MultiHeadAttention):
+    """Causal multi-head self attention, with the same weights and outputs as
+    MultiHeadAttention with use_causal_mask=True, but skipping the masked
+    blocks of attention weights. If chunk_size is set, is computed chunk_size
+    steps at a time so that memory is linear in the number of steps. Does not
+    return the attention scores, or take an attention mask."""
+
+    def __init__(self, chunk_size=None, **kwargs):
+        super().__init__(**kwargs)
+        self.chunk_size = chunk_size
+
+    def get_config(self):
+        config = super().get_config()
+        config["chunk_size"] = self.chunk_size
+        return config
+
+    def _compute_attention(self, query, key, value, attention_mask=None, training=None):
+        if attention_mask is not None:
+            raise ValueError(
+                "CausalMultiHeadAttention only applies its own causal mask, not "
+                "attention_mask (or use_causal_mask)."
+            )
+        # (?, T, heads, d) -> (?, heads, T, d)
+        query, key, value = [tf.transpose(x, [0, 2, 1, 3]) for x in [query, key, value]]
+        if self.chunk_size:
+            outputs = chunked_causal_attention(
+                query, key, value, self.chunk_size, self._dropout, training
+            )
+        else:
+            outputs = blocked_causal_attention(
+                query,
+                key,
+                value,
+                dropout=lambda weights: self._dropout_layer(weights, training=training),
+            )
+        return tf.transpose(outputs, [0, 2, 1, 3]), None
+
+
+class Time2Vec(tf.keras.layers.Layer):
+    """Adds a learnt embedding of each step's position (Time2Vec) to inputs of
+    shape=(?, T, d_model): one linear and d_model - 1 periodic features,
+    computed once for all steps and broadcast over the batch."""
+
+    def build(self, input_shape):
+        self.frequencies = self.add_weight(
+            name="frequencies", shape=(input_shape[-1],), initializer="uniform"
+        )
+        self.phases = self.add_weight(
+            name="phases", shape=(input_shape[-1],), initializer="uniform"
+        )
+        super().build(input_shape)
+
+    def call(self, inputs):
+        positions = tf.cast(tf.range(tf.shape(inputs)[-2]), self.frequencies.dtype)
+        time = positions[:, tf.newaxis] * self.frequencies + self.phases
+        embedding = tf.concat([time[:, :1], tf.sin(time[:, 1:])], axis=-1)
+        return inputs + tf.cast(embedding, inputs.dtype)
+
 
 class PositionEmbeddingFixedWeights(tf.keras.layers.Layer):
     def __init__(self, sequence_length, vocab_size, output_dim, **kwargs):
@@ -784,13 +1335,7 @@ class PositionEmbeddingFixedWeights(tf.keras.layers.Layer):
         )
              
     def get_position_encoding(self, seq_len, d, n=10000):
-        P = np.zeros((seq_len, d))
-        for k in range(seq_len):
-            for i in np.arange(int(d/2)):
-                denominator = np.power(n, 2*i/d)
-                P[k, 2*i] = np.sin(k/denominator)
-                P[k, 2*i+1] = np.cos(k/denominator)
-        return P
+        return position_encoding(seq_len, d, n)
  
  
     def call(self, inputs):        
@@ -798,88 +1343,3 @@ class PositionEmbeddingFixedWeights(tf.keras.layers.Layer):
         embedded_words = self.word_embedding_layer(inputs)
         embedded_indices = self.position_embedding_layer(position_indices)
         return embedded_words + embedded_indices
-
-# class T2V(tf.keras.layers.Layer):
-    
-#     def __init__(self, output_dim=None, **kwargs):
-#         self.output_dim = output_dim
-#         super(T2V, self).__init__(**kwargs)
-        
-#     def build(self, input_shape):
-#         self.W = self.add_weight(name='W',
-#                       shape=(input_shape[1], self.output_dim),
-#                       initializer='uniform',
-#                       trainable=True)
-#         self.P = self.add_weight(name='P',
-#                       shape=(input_shape[1], self.output_dim),
-#                       initializer='uniform',
-#                       trainable=True)
-#         self.w = self.add_weight(name='w',
-#                       shape=(input_shape[1], 1),
-#                       initializer='uniform',
-#                       trainable=True)
-#         self.p = self.add_weight(name='p',
-#                       shape=(input_shape[1], 1),
-#                       initializer='uniform',
-#                       trainable=True)
-#         super(T2V, self).build(input_shape)
-        
-#     def call(self, x):
-        
-#         original = self.w * x + self.p
-#         sin_trans = tf.math.sin(tf.multiply(x, self.W) + self.P)
-
-#         return tf.concat([sin_trans, original], -1)
-    
-
-
-
-
-# class Time2Vector(tf.keras.layers.Layer):
-#   def __init__(self, seq_len, model_dim, **kwargs):
-#     super(Time2Vector, self).__init__()
-#     self.seq_len = seq_len
-#     self.output_dim = model_dim
-
-#   def build(self, input_shape):
-#     '''Initialize weights and biases with shape (batch, seq_len)'''
-#     self.weights_linear = self.add_weight(name='weight_linear',
-#                                 shape=(1, int(self.seq_len), 1),
-#                                 initializer='uniform',
-#                                 trainable=True)
-    
-#     self.bias_linear = self.add_weight(name='bias_linear',
-#                                 shape=(1, int(self.seq_len),1),
-#                                 initializer='uniform',
-#                                 trainable=True)
-    
-#     self.weights_periodic = self.add_weight(name='weight_periodic',
-#                                 shape=(1, int(self.seq_len),self.output_dim),
-#                                 initializer='uniform',
-#                                 trainable=True)
-
-#     self.bias_periodic = self.add_weight(name='bias_periodic',
-#                                 shape=(1, int(self.seq_len),self.output_dim),
-#                                 initializer='uniform',
-#                                 trainable=True)
-    
-#     super(Time2Vector, self).build(self.seq_len)
-
-#   def call(self, x):
-#     '''Calculate linear and periodic time features'''
-#     # x = tf.math.reduce_mean(x[:,:,:4], axis=-1)
-#     x = tf.expand_dims(x, axis = -1) 
-#     time_linear = self.weights_linear * x + self.bias_linear # Linear time feature
-#     # time_linear = tf.expand_dims(time_linear, axis=-1) # Add dimension (batch, seq_len, 1)
-    
-#     time_periodic = tf.math.sin(tf.multiply(x, self.weights_periodic) + self.bias_periodic)
-#     # time_periodic = tf.expand_dims(time_periodic, axis=-1) # Add dimension (batch, seq_len, 1)
-#     return tf.concat([time_linear, time_periodic], axis=-1) # shape = (batch, seq_len, 2)
-
-#   def get_config(self): # Needed for saving and loading model with custom layer
-#     config = super().get_config().copy()
-#     config.update({'seq_len': self.seq_len})
-#     return config
-  
-#   def compute_output_shape(self, input_shape): 
-#     return (input_shape[0], input_shape[1], self.output_dim)
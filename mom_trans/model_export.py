@@ -0,0 +1,221 @@
+"""Exports trained models for serving, without keras_tuner or the model code."""
+import os
+import json
+import time
+
+import numpy as np
+import tensorflow as tf
+from tensorflow.python.framework.convert_to_constants import (
+    convert_variables_to_constants_v2,
+)
+
+QUANTISATION_TYPES = ["float16", "int8"]
+# smaller constants, e.g. shapes and biases, are kept in full precision
+MIN_QUANTISED_SIZE = 1024
+
+
+def _freeze(model: tf.keras.Model):
+    """Returns the inference graph of a model (no dropout), with its weights as
+    constants, and the names of the weight constants. The number of time steps
+    is fixed, so the causal mask is constant folded when the graph is optimised."""
+    predict = tf.function(
+        lambda inputs: model(inputs, training=False),
+        input_signature=[
+            tf.TensorSpec((None,) + tuple(model.input_shape[1:]), tf.float32)
+        ],
+    ).get_concrete_function()
+    # the weight constants keep the names of the variable handles they replace
+    weight_names = {
+        tensor.op.name
+        for tensor in predict.graph.internal_captures
+        if tensor.dtype == tf.resource
+    }
+    return convert_variables_to_constants_v2(predict), weight_names
+
+
+def _const_node(name: str, value: np.array):
+    node = tf.compat.v1.NodeDef(name=name, op="Const")
+    node.attr["dtype"].type = tf.as_dtype(value.dtype).as_datatype_enum
+    node.attr["value"].tensor.CopyFrom(tf.make_tensor_proto(value))
+    return node
+
+
+def _cast_node(name: str, input_name: str, src_dtype):
+    node = tf.compat.v1.NodeDef(name=name, op="Cast", input=[input_name])
+    node.attr["SrcT"].type = tf.as_dtype(src_dtype).as_datatype_enum
+    node.attr["DstT"].type = tf.float32.as_datatype_enum
+    return node
+
+
+def _quantise_graph_def(graph_def, quantisation: str, weight_names: set):
+    """Stores the weights of a frozen graph as float16, or as int8 with a float32
+    scale per output channel, cast back to float32 when the graph is loaded.
+    Other constants, e.g. the -1e9 causal mask, which overflows float16, are kept.
+
+    Args:
+      graph_def: Frozen graph
+      quantisation: One of QUANTISATION_TYPES
+      weight_names: Names of the constants holding the model's weights
+
+    Returns:
+      Quantised graph, with the same input and output names
+    """
+    quantised = tf.compat.v1.GraphDef()
+    quantised.versions.CopyFrom(graph_def.versions)
+    quantised.library.CopyFrom(graph_def.library)
+
+    for node in graph_def.node:
+        if (
+            node.name not in weight_names
+            or node.op != "Const"
+            or node.attr["dtype"].type != tf.float32.as_datatype_enum
+        ):
+            quantised.node.append(node)
+            continue
+        weights = tf.make_ndarray(node.attr["value"].tensor)
+        if weights.size < MIN_QUANTISED_SIZE:
+            quantised.node.append(node)
+            continue
+
+        if quantisation == "float16":
+            stored = _const_node(f"{node.name}/float16", weights.astype(np.float16))
+            cast = _cast_node(node.name, stored.name, np.float16)
+            quantised.node.extend([stored, cast])
+        else:
+            # symmetric, with one scale per output channel (last axis)
+            scale = np.max(np.abs(weights), axis=tuple(range(weights.ndim - 1))) / 127
+            scale = np.where(scale > 0, scale, 1).astype(np.float32)
+            stored = _const_node(
+                f"{node.name}/int8", np.round(weights / scale).astype(np.int8)
+            )
+            scale_node = _const_node(f"{node.name}/scale", scale)
+            cast = _cast_node(f"{node.name}/dequantise", stored.name, np.int8)
+            dequantised = tf.compat.v1.NodeDef(
+                name=node.name, op="Mul", input=[cast.name, scale_node.name]
+            )
+            dequantised.attr["T"].type = tf.float32.as_datatype_enum
+            quantised.node.extend([stored, scale_node, cast, dequantised])
+
+    return quantised
+
+
+def _save_graph_def(graph_def, input_name: str, output_name: str, path: str):
+    """Saves a frozen graph as a SavedModel with a single serving signature."""
+
+    def import_graph_def():
+        tf.compat.v1.import_graph_def(graph_def, name="")
+
+    wrapped = tf.compat.v1.wrap_function(import_graph_def, [])
+    predict = wrapped.prune(
+        wrapped.graph.get_tensor_by_name(input_name),
+        wrapped.graph.get_tensor_by_name(output_name),
+    )
+    module = tf.Module()
+    module.predict = tf.function(
+        lambda inputs: {"positions": predict(inputs)},
+        input_signature=[
+            tf.TensorSpec(predict.inputs[0].shape, tf.float32, name="inputs")
+        ],
+    )
+    tf.saved_model.save(module, path, signatures=module.predict)
+
+
+def load_exported_model(path: str):
+    """Loads an exported model.
+
+    Args:
+      path: SavedModel directory written by export_model
+
+    Returns:
+      Function mapping inputs of shape=(?, time_steps, input_size) to a numpy
+      array of model outputs.
+    """
+    predict = tf.saved_model.load(path).signatures["serving_default"]
+    return lambda inputs: predict(
+        inputs=tf.convert_to_tensor(inputs, dtype=tf.float32)
+    )["positions"].numpy()
+
+
+def _directory_size_mb(path: str) -> float:
+    return (
+        sum(
+            os.path.getsize(os.path.join(root, file_name))
+            for root, _, file_names in os.walk(path)
+            for file_name in file_names
+        )
+        / 2 ** 20
+    )
+
+
+def _latency_ms(predict, inputs: np.array, repeats: int) -> float:
+    """Average time of one call, after a first call to trace and optimise."""
+    predict(inputs)
+    start = time.time()
+    for _ in range(repeats):
+        predict(inputs)
+    return (time.time() - start) / repeats * 1000
+
+
+def export_model(
+    model: tf.keras.Model,
+    directory: str,
+    sample_inputs: np.array,
+    quantisation: str = None,
+    repeats: int = 10,
+) -> dict:
+    """Exports a trained model as a frozen, inference only SavedModel, and
+    optionally a weight quantised copy, reporting their latency and accuracy
+    against the Keras model.
+
+    Args:
+      model: Trained model
+      directory: Directory for the SavedModel(s) and export_report.json
+      sample_inputs: Batch of inputs used for the comparison
+      quantisation: Also export a copy with weights stored as "float16" or "int8"
+      repeats: Number of timed calls per model
+
+    Returns:
+      Dictionary of latency (ms per batch), size (MB) and absolute errors of the
+      outputs against the Keras model, for each exported model.
+    """
+    if quantisation is not None and quantisation not in QUANTISATION_TYPES:
+        raise ValueError(
+            f"Unknown quantisation {quantisation}, "
+            f"expected one of {QUANTISATION_TYPES}."
+        )
+    os.makedirs(directory, exist_ok=True)
+
+    frozen, weight_names = _freeze(model)
+    graph_def = frozen.graph.as_graph_def()
+    input_name, output_name = frozen.inputs[0].name, frozen.outputs[0].name
+
+    exported = {"saved_model": graph_def}
+    if quantisation:
+        exported[f"saved_model_{quantisation}"] = _quantise_graph_def(
+            graph_def, quantisation, weight_names
+        )
+
+    sample_inputs = sample_inputs.astype(np.float32)
+    keras_outputs = model.predict_on_batch(sample_inputs)
+    report = {
+        "keras": {
+            "latency_ms": _latency_ms(model.predict_on_batch, sample_inputs, repeats)
+        }
+    }
+    for name, exported_graph_def in exported.items():
+        path = os.path.join(directory, name)
+        _save_graph_def(exported_graph_def, input_name, output_name, path)
+        predict = load_exported_model(path)
+        errors = np.abs(predict(sample_inputs) - keras_outputs)
+        report[name] = {
+            "latency_ms": _latency_ms(predict, sample_inputs, repeats),
+            "size_mb": _directory_size_mb(path),
+            "max_abs_error": float(errors.max()),
+            "mean_abs_error": float(errors.mean()),
+        }
+
+    with open(os.path.join(directory, "export_report.json"), "w") as file:
+        file.write(json.dumps(report, indent=4))
+    for name, results in report.items():
+        print(f"{name}: " + ", ".join(f"{k} = {v:.6g}" for k, v in results.items()))
+    return report
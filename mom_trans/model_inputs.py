@@ -5,6 +5,8 @@ import sklearn.preprocessing
 import pandas as pd
 import datetime as dt
 import enum
+import ctypes
+import multiprocessing
 
 from sklearn.preprocessing import MinMaxScaler
 
@@ -59,6 +61,182 @@ def extract_cols_from_data_type(data_type, column_definition, excluded_input_typ
     ]
 
 
+def _base_column_definition():
+    """Returns the column definition before any static inputs are added."""
+    return [
+        ("ticker", DataTypes.CATEGORICAL, InputTypes.ID),
+        ("date", DataTypes.DATE, InputTypes.TIME),
+        ("target_dir", DataTypes.REAL_VALUED, InputTypes.TARGET),
+        ("norm_daily_return", DataTypes.REAL_VALUED, InputTypes.KNOWN_INPUT),
+        ("norm_monthly_return", DataTypes.REAL_VALUED, InputTypes.KNOWN_INPUT),
+        ("norm_quarterly_return", DataTypes.REAL_VALUED, InputTypes.KNOWN_INPUT),
+        ("norm_biannual_return", DataTypes.REAL_VALUED, InputTypes.KNOWN_INPUT),
+        ("norm_annual_return", DataTypes.REAL_VALUED, InputTypes.KNOWN_INPUT),
+        # ("daily_return", DataTypes.REAL_VALUED, InputTypes.KNOWN_INPUT),
+        # ("monthly_return", DataTypes.REAL_VALUED, InputTypes.KNOWN_INPUT),
+        # # ("quarterly_return", DataTypes.REAL_VALUED, InputTypes.KNOWN_INPUT),
+        # # ("biannual_return", DataTypes.REAL_VALUED, InputTypes.KNOWN_INPUT),
+        # ("annual_return", DataTypes.REAL_VALUED, InputTypes.KNOWN_INPUT),
+        # ("3y_return", DataTypes.REAL_VALUED, InputTypes.KNOWN_INPUT),
+        ("macd_8_24", DataTypes.REAL_VALUED, InputTypes.KNOWN_INPUT),
+        ("macd_16_48", DataTypes.REAL_VALUED, InputTypes.KNOWN_INPUT),
+        ("macd_32_96", DataTypes.REAL_VALUED, InputTypes.KNOWN_INPUT),
+        # ("daily_vol", DataTypes.REAL_VALUED, InputTypes.KNOWN_INPUT),
+        # ("vol", DataTypes.REAL_VALUED, InputTypes.KNOWN_INPUT),
+        # ("turn", DataTypes.REAL_VALUED, InputTypes.KNOWN_INPUT),
+        # ("dolvol", DataTypes.REAL_VALUED, InputTypes.KNOWN_INPUT),
+        # ("ill", DataTypes.REAL_VALUED, InputTypes.KNOWN_INPUT),
+        # ("baspread", DataTypes.REAL_VALUED, InputTypes.KNOWN_INPUT),
+        # ("ep", DataTypes.REAL_VALUED, InputTypes.KNOWN_INPUT),
+        # ("sp", DataTypes.REAL_VALUED, InputTypes.KNOWN_INPUT),
+        # ("bm", DataTypes.REAL_VALUED, InputTypes.KNOWN_INPUT),
+        # ("mve_log", DataTypes.REAL_VALUED, InputTypes.KNOWN_INPUT),
+        # ("beta", DataTypes.REAL_VALUED, InputTypes.KNOWN_INPUT),
+    ]
+
+
+def _add_static_ticker_inputs(
+    df, column_definition, asset_class_dictionary, static_ticker_type_feature
+):
+    """Adds the ticker (and optionally its asset class) as static categorical inputs.
+    Args:
+      df: Data frame to add the static columns to, modified in place
+      column_definition: Column definition list to append to, modified in place
+      asset_class_dictionary: Mapping of ticker to asset class
+      static_ticker_type_feature: Whether to add the asset class as a static input
+    """
+    column_definition.append(
+        (f"static_ticker", DataTypes.CATEGORICAL, InputTypes.STATIC_INPUT)
+    )
+    df["static_ticker"] = df["ticker"]
+    df["static_ticker"] = df["static_ticker"].astype('str')
+    if static_ticker_type_feature:
+        df["static_ticker_type"] = df["ticker"].map(
+            lambda t: asset_class_dictionary[t]
+        )
+        column_definition.append(
+            (
+                f"static_ticker_type",
+                DataTypes.CATEGORICAL,
+                InputTypes.STATIC_INPUT,
+            )
+        )
+
+
+def _get_storage_dtype(storage_dtype, num_classes_per_cat_input):
+    """Returns the numpy dtype used to store batched inputs, outputs and active entries.
+    Args:
+      storage_dtype: Name of a floating point dtype, e.g. "float32" or "float16"
+      num_classes_per_cat_input: Number of categories per categorical input, which
+        are stored as codes alongside the real valued inputs
+    """
+    storage_dtype = np.dtype(storage_dtype)
+    if storage_dtype.kind != "f":
+        raise ValueError("Invalid storage dtype {}".format(storage_dtype))
+
+    # largest integer below which all integers are exactly representable
+    max_exact_code = 2 ** (np.finfo(storage_dtype).nmant + 1)
+    if (
+        num_classes_per_cat_input
+        and max(num_classes_per_cat_input) - 1 > max_exact_code
+    ):
+        raise ValueError(
+            "Categorical codes up to {} cannot be stored exactly as {}".format(
+                max(num_classes_per_cat_input) - 1, storage_dtype
+            )
+        )
+    return storage_dtype
+
+
+def _categories_as_str(srs):
+    """Distinct values of a column as str, so that we don't have mixed integer/string
+    columns, without converting every row."""
+    return set(srs.astype("category").cat.categories.astype(str))
+
+
+def _label_encoder(categories):
+    """Returns a LabelEncoder for a set of str categories."""
+    encoder = sklearn.preprocessing.LabelEncoder()
+    encoder.classes_ = np.array(sorted(categories), dtype=object)
+    return encoder
+
+
+def _encode_categorical(srs, encoder):
+    """Label encodes a column through its pandas categorical codes."""
+    categorical = srs.astype("category").cat
+    categories = np.asarray(categorical.categories.astype(str), dtype=object)
+    return encoder.transform(categories)[categorical.codes]
+
+
+# shared buffers of the batching worker processes, set by _init_window_worker
+_window_buffers = {}
+
+
+def _init_window_worker(buffers):
+    """Pool initializer, exposes the shared source and output arrays to a worker."""
+    _window_buffers.update(buffers)
+
+
+def _shared_array(buffer, shape, dtype):
+    return np.frombuffer(buffer, dtype=dtype).reshape(shape)
+
+
+def _fill_windows(task):
+    """Writes the windows of a shard of tickers into the shared output arrays.
+    Args:
+      task: Tuple of (first row of every window in the shard, offset of the shard
+        in the output arrays)
+    """
+    starts, offset = task
+    for src_buffer, src_shape, out_buffer, out_shape, dtype in _window_buffers.values():
+        src = _shared_array(src_buffer, src_shape, dtype)
+        out = _shared_array(out_buffer, out_shape, dtype)
+        seq_len = out_shape[1]
+        out[offset : offset + len(starts)] = src[
+            starts[:, np.newaxis] + np.arange(seq_len)
+        ]
+
+
+def _gather_windows_parallel(arrays, shards, seq_len, n_workers):
+    """Gathers sliding windows from 2-D arrays using a pool of worker processes.
+
+    Outputs are preallocated in shared memory and every worker writes its shards
+    in place, at offsets computed up front, so no concatenation is required.
+
+    Args:
+      arrays: Dictionary of numeric 2-D arrays to window
+      shards: List of arrays with the first row of every window, one per shard
+      seq_len: Number of time steps per window
+      n_workers: Number of worker processes
+    Returns:
+      Dictionary of 3-D arrays with shape=(?, seq_len, columns).
+    """
+    sizes = [len(starts) for starts in shards]
+    offsets = np.cumsum([0] + sizes[:-1])
+    num_windows = int(np.sum(sizes))
+    # tensorflow is not fork safe, and may be running in this process
+    context = multiprocessing.get_context("spawn")
+
+    buffers, outputs = {}, {}
+    for k, arr in arrays.items():
+        dtype = arr.dtype.str
+        src_buffer = context.RawArray(ctypes.c_char, arr.nbytes)
+        _shared_array(src_buffer, arr.shape, dtype)[:] = arr
+        out_shape = (num_windows, seq_len, arr.shape[1])
+        out_buffer = context.RawArray(
+            ctypes.c_char, int(np.prod(out_shape)) * arr.itemsize
+        )
+        buffers[k] = (src_buffer, arr.shape, out_buffer, out_shape, dtype)
+        outputs[k] = _shared_array(out_buffer, out_shape, dtype)
+
+    with context.Pool(
+        processes=n_workers, initializer=_init_window_worker, initargs=(buffers,)
+    ) as pool:
+        pool.map(_fill_windows, list(zip(shards, offsets)))
+
+    return outputs
+
+
 class ModelFeatures:
     """Defines and formats data for the MomentumCp dataset.
     Attributes:
@@ -85,39 +263,15 @@ class ModelFeatures:
         lags=None,
         asset_class_dictionary=None,
         static_ticker_type_feature = True,
+        storage_dtype="float32",
+        n_batching_workers=1,
     ):
         """Initialises formatter. Splits data frame into training-validation-test data frames.
-        This also calibrates scaling object, and transforms data for each split."""
-        self._column_definition = [
-            ("ticker", DataTypes.CATEGORICAL, InputTypes.ID),
-            ("date", DataTypes.DATE, InputTypes.TIME),
-            ("target_dir", DataTypes.REAL_VALUED, InputTypes.TARGET),
-            ("norm_daily_return", DataTypes.REAL_VALUED, InputTypes.KNOWN_INPUT),
-            ("norm_monthly_return", DataTypes.REAL_VALUED, InputTypes.KNOWN_INPUT),
-            ("norm_quarterly_return", DataTypes.REAL_VALUED, InputTypes.KNOWN_INPUT),
-            ("norm_biannual_return", DataTypes.REAL_VALUED, InputTypes.KNOWN_INPUT),
-            ("norm_annual_return", DataTypes.REAL_VALUED, InputTypes.KNOWN_INPUT),
-            # ("daily_return", DataTypes.REAL_VALUED, InputTypes.KNOWN_INPUT),
-            # ("monthly_return", DataTypes.REAL_VALUED, InputTypes.KNOWN_INPUT),
-            # # ("quarterly_return", DataTypes.REAL_VALUED, InputTypes.KNOWN_INPUT),
-            # # ("biannual_return", DataTypes.REAL_VALUED, InputTypes.KNOWN_INPUT),
-            # ("annual_return", DataTypes.REAL_VALUED, InputTypes.KNOWN_INPUT),
-            # ("3y_return", DataTypes.REAL_VALUED, InputTypes.KNOWN_INPUT),
-            ("macd_8_24", DataTypes.REAL_VALUED, InputTypes.KNOWN_INPUT),
-            ("macd_16_48", DataTypes.REAL_VALUED, InputTypes.KNOWN_INPUT),
-            ("macd_32_96", DataTypes.REAL_VALUED, InputTypes.KNOWN_INPUT),
-            # ("daily_vol", DataTypes.REAL_VALUED, InputTypes.KNOWN_INPUT),
-            # ("vol", DataTypes.REAL_VALUED, InputTypes.KNOWN_INPUT),
-            # ("turn", DataTypes.REAL_VALUED, InputTypes.KNOWN_INPUT),
-            # ("dolvol", DataTypes.REAL_VALUED, InputTypes.KNOWN_INPUT),
-            # ("ill", DataTypes.REAL_VALUED, InputTypes.KNOWN_INPUT),
-            # ("baspread", DataTypes.REAL_VALUED, InputTypes.KNOWN_INPUT),
-            # ("ep", DataTypes.REAL_VALUED, InputTypes.KNOWN_INPUT),
-            # ("sp", DataTypes.REAL_VALUED, InputTypes.KNOWN_INPUT),
-            # ("bm", DataTypes.REAL_VALUED, InputTypes.KNOWN_INPUT),
-            # ("mve_log", DataTypes.REAL_VALUED, InputTypes.KNOWN_INPUT),
-            # ("beta", DataTypes.REAL_VALUED, InputTypes.KNOWN_INPUT),
-        ]
+        This also calibrates scaling object, and transforms data for each split.
+        Batched inputs, outputs and active entries are stored as `storage_dtype`, Keras
+        casts each batch to float32 when it is fed to the model. Sliding windows are
+        batched by `n_batching_workers` processes when it is more than one."""
+        self._column_definition = _base_column_definition()
 
         print('create features')
         df = df.dropna()
@@ -136,6 +290,7 @@ class ModelFeatures:
         self._num_classes_per_cat_input = None
         self.total_time_steps = total_time_steps
         self.lags = lags
+        self.n_batching_workers = n_batching_workers
 
 #         if changepoint_lbws:
 #             for lbw in changepoint_lbws:
@@ -187,22 +342,12 @@ class ModelFeatures:
 
         print('add ticker as static')
         if add_ticker_as_static:
-            self._column_definition.append(
-                (f"static_ticker", DataTypes.CATEGORICAL, InputTypes.STATIC_INPUT)
+            _add_static_ticker_inputs(
+                df,
+                self._column_definition,
+                asset_class_dictionary,
+                static_ticker_type_feature,
             )
-            df["static_ticker"] = df["ticker"]
-            df["static_ticker"] = df["static_ticker"].astype('str')
-            if static_ticker_type_feature:
-                df["static_ticker_type"] = df["ticker"].map(
-                    lambda t: asset_class_dictionary[t]
-                )
-                self._column_definition.append(
-                    (
-                        f"static_ticker_type",
-                        DataTypes.CATEGORICAL,
-                        InputTypes.STATIC_INPUT,
-                    )
-                )
 
         print('transform inputs')
         self.transform_real_inputs = transform_real_inputs
@@ -306,6 +451,9 @@ class ModelFeatures:
         self.tickers = tickers
         self.num_tickers = len(tickers)
         self.set_scalers(train)
+        self.storage_dtype = _get_storage_dtype(
+            storage_dtype, self._num_classes_per_cat_input
+        )
 
         train, valid, test, test_with_buffer = [
             self.transform_inputs(data)
@@ -331,6 +479,42 @@ class ModelFeatures:
             self.test_fixed = self._batch_data(test, False)
             self.test_sliding = self._batch_data(test_with_buffer, True)
 
+    @classmethod
+    def from_windowed_panel(cls, panel, start_boundary, test_boundary, test_end=None):
+        """Formats a single backtest interval by selecting windows from a shared panel.
+        Args:
+          panel: WindowedPanel built once over the full history of the experiment
+          start_boundary: First year of training data
+          test_boundary: First year of test data
+          test_end: Year at which the test data ends (exclusive)
+        Returns:
+          ModelFeatures with the train, valid and test sets of the interval.
+        """
+        features = cls.__new__(cls)
+        features._column_definition = panel.column_definition
+        features.total_time_steps = panel.total_time_steps
+        features.lags = None
+        features.n_batching_workers = 1
+        features.storage_dtype = panel.storage_dtype
+        features.transform_real_inputs = False
+        features._real_scalers = None
+        features._target_scaler = None
+        features._cat_scalers = panel.cat_scalers
+        features._num_classes_per_cat_input = panel.num_classes_per_cat_input
+
+        masks, tickers = panel.split_masks(start_boundary, test_boundary, test_end)
+        features.identifiers = tickers
+        features.tickers = tickers
+        features.num_tickers = len(tickers)
+
+        features.train = panel.select(masks["train"])
+        features.valid = panel.select(masks["valid"])
+        features.test_sliding = panel.select(masks["test_sliding"])
+        features.test_fixed = features._batch_data(
+            panel.test_data(tickers, test_boundary, test_end), False
+        )
+        return features
+
     def set_scalers(self, df):
         """Calibrates scalers using the data supplied.
         Args:
@@ -368,12 +552,10 @@ class ModelFeatures:
         categorical_scalers = {}
         num_classes = []
         for col in categorical_inputs:
-            # Set all to str so that we don't have mixed integer/string columns
-            srs = df[col].apply(str)
-            categorical_scalers[col] = sklearn.preprocessing.LabelEncoder().fit(
-                srs.values
-            )
-            num_classes.append(srs.nunique())
+            # str categories, converted once per distinct value rather than per row
+            categories = _categories_as_str(df[col])
+            categorical_scalers[col] = _label_encoder(categories)
+            num_classes.append(len(categories))
 
         # Set categorical scaler outputs
         self._cat_scalers = categorical_scalers
@@ -411,8 +593,7 @@ class ModelFeatures:
 
         # Format categorical inputs
         for col in categorical_inputs:
-            string_df = df[col].apply(str)
-            output[col] = self._cat_scalers[col].transform(string_df)
+            output[col] = _encode_categorical(df[col], self._cat_scalers[col])
 
         return output
 
@@ -528,7 +709,33 @@ class ModelFeatures:
 
         data_map = {}
 
-        if sliding_window:
+        if sliding_window and self.n_batching_workers > 1:
+            order, starts, batch_size = self._window_starts(data[id_col].values, True)
+            numeric_cols = {"outputs": [target_col], "inputs": input_cols}
+            # shard contiguous groups of tickers across the workers
+            first_window = np.cumsum(batch_size) - batch_size
+            ticker_shards = np.array_split(
+                np.arange(len(batch_size)), self.n_batching_workers
+            )
+            shards = np.split(
+                starts, [first_window[t[0]] for t in ticker_shards[1:] if len(t)]
+            )
+            data_map = _gather_windows_parallel(
+                {
+                    k: data[cols].values[order].astype(self.storage_dtype)
+                    for k, cols in numeric_cols.items()
+                },
+                shards,
+                self.total_time_steps,
+                self.n_batching_workers,
+            )
+
+            idx = order[starts[:, np.newaxis] + np.arange(self.total_time_steps)]
+            data_map["identifier"] = data[[id_col]].values[idx]
+            data_map["date"] = data[[time_col]].values[idx]
+            data_map["active_entries"] = np.ones_like(data_map["outputs"])
+
+        elif sliding_window:
             # Functions.
             def _batch_single_entity(input_data):
                 time_steps = len(input_data)
@@ -561,6 +768,7 @@ class ModelFeatures:
                         print("output is None")
                         continue
                         
+                    arr = self._to_storage_dtype(k, arr)
                     if k not in data_map:
                         data_map[k] = [arr]
                     else:
@@ -602,7 +810,7 @@ class ModelFeatures:
                 # for k in col_mappings:
                 k = "outputs"
                 cols = col_mappings[k]
-                arr = _batch_single_entity(sliced[cols].copy())
+                arr = self._to_storage_dtype(k, _batch_single_entity(sliced[cols].copy()))
 
                 batch_size = arr.shape[0]
                 sequence_lengths = [
@@ -634,7 +842,7 @@ class ModelFeatures:
 
                 for k in set(col_mappings) - {"outputs"}:
                     cols = col_mappings[k]
-                    arr = _batch_single_entity(sliced[cols].copy())
+                    arr = self._to_storage_dtype(k, _batch_single_entity(sliced[cols].copy()))
 
                     if k not in data_map:
                         data_map[k] = [arr[sequence_lengths > 0, :, :]]
@@ -645,7 +853,9 @@ class ModelFeatures:
             for k in data_map:
                 data_map[k] = np.concatenate(data_map[k], axis=0)
 
-        active_flags = (np.sum(data_map["active_entries"], axis=-1) > 0.0) * 1.0
+        active_flags = (np.sum(data_map["active_entries"], axis=-1) > 0.0).astype(
+            self.storage_dtype
+        )
         data_map["inputs"] = data_map["inputs"][: len(active_flags)]
         data_map["outputs"] = data_map["outputs"][: len(active_flags)]
         data_map["active_entries"] = active_flags
@@ -655,11 +865,62 @@ class ModelFeatures:
         data_map["date"][data_map["date"] == 0] = ""
         return data_map
 
+    def _to_storage_dtype(self, key, arr):
+        """Casts batched inputs, outputs and active entries to the storage dtype."""
+        if key in {"inputs", "outputs", "active_entries"}:
+            return arr.astype(self.storage_dtype, copy=False)
+        return arr
+
+    def _window_starts(self, identifiers, sliding_window, output_length=1):
+        """Locates the windows of every ticker.
+
+        Args:
+          identifiers: Ticker of every row, rows are in time order for each ticker
+          sliding_window: Whether windows overlap, otherwise consecutive windows are
+            `output_length` apart and the earliest rows of a ticker are disregarded
+          output_length: Number of time steps per window used as outputs
+
+        Returns:
+          Tuple of (row order grouping the rows by ticker as groupby does, first
+            row in that order of every window, number of windows per ticker).
+        """
+        # same ticker order as groupby, keeping the row order within each ticker
+        order = np.argsort(identifiers, kind="mergesort")
+        _, block_start, time_steps = np.unique(
+            identifiers[order], return_index=True, return_counts=True
+        )
+
+        seq_len = self.total_time_steps
+        if sliding_window:
+            batch_size = np.maximum(time_steps - seq_len + 1, 0)
+            disregard_time_steps = np.zeros_like(time_steps)
+            stride = 1
+        else:
+            batch_size = np.maximum(
+                (time_steps - seq_len + output_length) // output_length, 0
+            )
+            active_time_steps = batch_size * output_length + (seq_len - output_length)
+            disregard_time_steps = np.where(
+                batch_size > 0, time_steps % np.maximum(active_time_steps, 1), 0
+            )
+            stride = output_length
+
+        # first row of every window, in ticker then time order
+        window_number = np.arange(batch_size.sum()) - np.repeat(
+            np.cumsum(batch_size) - batch_size, batch_size
+        )
+        starts = (
+            np.repeat(block_start + disregard_time_steps, batch_size)
+            + stride * window_number
+        )
+        return order, starts, batch_size
+
     def _batch_data_smaller_output(self, data, sliding_window, output_length):
         """Batches data for training.
 
         Converts raw dataframe from a 2-D tabular format to a batched 3-D array
-        to feed into Keras model.
+        to feed into Keras model. A single window index is computed for all
+        tickers and shared by every column group.
 
         Args:
           data: DataFrame to batch
@@ -667,14 +928,7 @@ class ModelFeatures:
         Returns:
           Batched Numpy array with shape=(?, self.time_steps, self.input_size)
         """
-        # TODO this works but is a bit of a mess
-        data = data.copy()
-        data["date"] = data.index.strftime("%Y-%m-%d")
-
         id_col = get_single_col_by_input_type(InputTypes.ID, self._column_definition)
-        time_col = get_single_col_by_input_type(
-            InputTypes.TIME, self._column_definition
-        )
         target_col = get_single_col_by_input_type(
             InputTypes.TARGET, self._column_definition
         )
@@ -685,79 +939,34 @@ class ModelFeatures:
             if tup[2] not in {InputTypes.ID, InputTypes.TIME, InputTypes.TARGET}
         ]
 
-        data_map = {}
-
-        col_mappings = {
-            "identifier": [id_col],
-            "date": [time_col],
-            "inputs": input_cols,
-            "outputs": [target_col],
+        seq_len = self.total_time_steps
+        order, starts, _ = self._window_starts(
+            data[id_col].values, sliding_window, output_length
+        )
+        idx = order[starts[:, np.newaxis] + np.arange(seq_len)]
+
+        data_map = {
+            "identifier": data[[id_col]].values[idx],
+            "date": data.index.strftime("%Y-%m-%d").values.reshape(-1, 1)[idx],
+            "inputs": data[input_cols].values.astype(self.storage_dtype)[idx],
+            "outputs": data[[target_col]]
+            .values.astype(self.storage_dtype)[idx[:, -output_length:]],
         }
 
-        if sliding_window:
-            for _, sliced in data.groupby(id_col):
-
-                time_steps = len(sliced)
-                batch_size = time_steps - self.total_time_steps + 1
-                seq_len = self.total_time_steps
-                for k in col_mappings:
-                    cols = col_mappings[k]
-                    arr = sliced[cols].copy().values
-                    arr = np.concatenate(
-                        [arr[start : start + seq_len] for start in range(0, batch_size)]
-                    ).reshape(-1, seq_len, arr.shape[1])
-
-                    if k not in data_map:
-                        data_map[k] = [arr]
-                    else:
-                        data_map[k].append(arr)
-
-        else:
-            for _, sliced in data.groupby(id_col):
-
-                time_steps = len(sliced)
-                batch_size = (
-                    time_steps - self.total_time_steps + output_length
-                ) // output_length
-                active_time_steps = batch_size * output_length + (
-                    self.total_time_steps - output_length
-                )
-                disregard_time_steps = time_steps % active_time_steps
-                seq_len = self.total_time_steps
-                for k in col_mappings:
-                    cols = col_mappings[k]
-                    arr = sliced[cols].copy().values[disregard_time_steps:]
-                    arr = np.concatenate(
-                        [
-                            arr[start : start + seq_len]
-                            for start in range(
-                                0, output_length * batch_size, output_length
-                            )
-                        ]
-                    ).reshape(-1, seq_len, arr.shape[1])
-
-                    if k not in data_map:
-                        data_map[k] = [arr]
-                    else:
-                        data_map[k].append(arr)
-
-        # Combine all data
-        for k in data_map:
-            data_map[k] = np.concatenate(data_map[k], axis=0)
-
-        data_map["active_entries"] = (np.sum(data_map["inputs"], axis=-1) > 0.0) * 1.0
+        data_map["active_entries"] = (
+            np.sum(data_map["inputs"], axis=-1) > 0.0
+        ).astype(self.storage_dtype)
         # TODO
         data_map["identifier"][data_map["identifier"] == 0] = ""
         data_map["date"][data_map["date"] == 0] = ""
 
-        data_map["inputs_identifier"] = data_map["identifier"].copy()
+        # views onto the full windows, rather than copies
+        data_map["inputs_identifier"] = data_map["identifier"]
         data_map["identifier"] = data_map["identifier"][:, -output_length:, :]
 
-        data_map["inputs_date"] = data_map["date"].copy()
+        data_map["inputs_date"] = data_map["date"]
         data_map["date"] = data_map["date"][:, -output_length:, :]
 
-        data_map["outputs"] = data_map["outputs"][:, -output_length:, :]
-
         return data_map
 
     def _get_input_columns(self):
@@ -829,3 +1038,195 @@ class ModelFeatures:
         }
 
         return locations
+
+
+class WindowedPanel:
+    """Sliding windows built once over the full history of a features panel.
+
+    All backtest intervals of an experiment share the label encoding and the
+    window index built here; each interval then selects its train, valid and
+    test windows through index masks (see ModelFeatures.from_windowed_panel).
+    Only sliding windows are supported, so neither `lags` nor
+    `transform_real_inputs` are available in this mode. The `start` and
+    `ending` columns are assumed to be constant for each ticker.
+
+    Attributes:
+      column_definition: Defines input and data type of column used in the
+        experiment.
+      data: Label encoded data frame, sorted by ticker.
+      window_start: Row of the first time step of every window.
+      window_ticker: Ticker index (into `tickers`) of every window.
+      window_year: Year of the final time step of every window.
+    """
+
+    def __init__(
+        self,
+        df,
+        total_time_steps,
+        train_valid_ratio=0.9,
+        split_tickers_individually=True,
+        add_ticker_as_static=True,
+        asset_class_dictionary=None,
+        static_ticker_type_feature=True,
+        storage_dtype="float32",
+    ):
+        """Label encodes the panel and indexes every sliding window of each ticker."""
+        self.column_definition = _base_column_definition()
+        self.total_time_steps = total_time_steps
+        self.train_valid_ratio = train_valid_ratio
+        self.split_tickers_individually = split_tickers_individually
+
+        df = df.dropna().copy()
+        if add_ticker_as_static:
+            _add_static_ticker_inputs(
+                df,
+                self.column_definition,
+                asset_class_dictionary,
+                static_ticker_type_feature,
+            )
+        # same ticker order as groupby, keeping the row order within each ticker
+        df = df.iloc[np.argsort(df["ticker"].values, kind="mergesort")]
+
+        categorical_inputs = extract_cols_from_data_type(
+            DataTypes.CATEGORICAL,
+            self.column_definition,
+            {InputTypes.ID, InputTypes.TIME, InputTypes.TARGET},
+        )
+        self.cat_scalers = {}
+        self.num_classes_per_cat_input = []
+        for col in categorical_inputs:
+            categories = _categories_as_str(df[col])
+            self.cat_scalers[col] = _label_encoder(categories)
+            df[col] = _encode_categorical(df[col], self.cat_scalers[col])
+            self.num_classes_per_cat_input.append(len(categories))
+        self.data = df
+        self.storage_dtype = _get_storage_dtype(
+            storage_dtype, self.num_classes_per_cat_input
+        )
+
+        id_col = get_single_col_by_input_type(InputTypes.ID, self.column_definition)
+        target_col = get_single_col_by_input_type(
+            InputTypes.TARGET, self.column_definition
+        )
+        input_cols = [
+            tup[0]
+            for tup in self.column_definition
+            if tup[2] not in {InputTypes.ID, InputTypes.TIME, InputTypes.TARGET}
+        ]
+        self._inputs = df[input_cols].values.astype(self.storage_dtype)
+        self._outputs = df[[target_col]].values.astype(self.storage_dtype)
+        self._identifier = df[[id_col]].values
+        self._date = df.index.strftime("%Y-%m-%d").values.reshape(-1, 1)
+
+        # row metadata used to select the windows of each interval
+        self._ticker_codes, tickers = pd.factorize(df[id_col])
+        self.tickers = list(tickers)
+        self._years = df["year"].values
+        self._dates = df.index.values
+        self._top2 = df["top2"].values
+        self._start_year = pd.to_datetime(df["start"]).dt.year.values
+        self._ending_year = pd.to_datetime(df["ending"]).dt.year.values
+
+        ticker_range = np.arange(len(self.tickers))
+        self._block_start = np.searchsorted(self._ticker_codes, ticker_range)
+        self._block_end = np.searchsorted(
+            self._ticker_codes, ticker_range, side="right"
+        )
+
+        rows = np.arange(len(df))
+        window_end = rows + total_time_steps - 1
+        complete = window_end < self._block_end[self._ticker_codes]
+        self.window_start = rows[complete]
+        self.window_ticker = self._ticker_codes[complete]
+        self.window_year = self._years[window_end[complete]]
+
+    def _first_row(self, row_mask):
+        """First row of each ticker after the (date sorted) rows in `row_mask`."""
+        return self._block_start + np.bincount(
+            self._ticker_codes[row_mask], minlength=len(self.tickers)
+        )
+
+    def split_masks(self, start_boundary, test_boundary, test_end=None):
+        """Assigns the windows of a single backtest interval to their split.
+        Args:
+          start_boundary: First year of training data
+          test_boundary: First year of test data
+          test_end: Year at which the test data ends (exclusive)
+        Returns:
+          Tuple of (dictionary of train, valid and test_sliding window masks,
+            list of tickers in the interval).
+        """
+        lags = self.total_time_steps
+        codes = self._ticker_codes
+
+        trainvalid_start = self._first_row(self._years < start_boundary)
+        test_start = self._first_row(self._years < test_boundary)
+        test_stop = (
+            self._first_row(self._years < test_end) if test_end else self._block_end
+        )
+
+        eligible = (
+            np.bincount(
+                codes[
+                    (self._years == test_boundary)
+                    & (self._top2 == 1)
+                    & (self._start_year < test_boundary)
+                    & (self._ending_year >= test_boundary)
+                ],
+                minlength=len(self.tickers),
+            )
+            > 0
+        ) & (test_start > trainvalid_start)
+
+        if self.split_tickers_individually:
+            train_stop = trainvalid_start + (
+                self.train_valid_ratio * (test_start - trainvalid_start)
+            ).astype(int)
+            valid_start = train_stop - (lags - 1)
+        else:
+            trainvalid = (
+                eligible[codes]
+                & (self._years >= start_boundary)
+                & (self._years < test_boundary)
+            )
+            dates = np.unique(self._dates[trainvalid])
+            split_date = dates[int(self.train_valid_ratio * len(dates))]
+            train_stop = self._first_row(self._dates < split_date)
+            valid_start = train_stop
+            eligible &= train_stop > trainvalid_start
+
+        ticker = self.window_ticker
+        start = self.window_start
+        end = start + lags - 1
+        in_interval = eligible[ticker] & (start >= trainvalid_start[ticker])
+        masks = {
+            "train": in_interval & (end < train_stop[ticker]),
+            "valid": in_interval
+            & (start >= valid_start[ticker])
+            & (end >= train_stop[ticker])
+            & (end < test_start[ticker]),
+            "test_sliding": in_interval
+            & (end >= test_start[ticker])
+            & (end < test_stop[ticker]),
+        }
+        return masks, [t for t, e in zip(self.tickers, eligible) if e]
+
+    def select(self, mask):
+        """Gathers the windows in `mask`, in the format of ModelFeatures._batch_data."""
+        idx = self.window_start[mask][:, np.newaxis] + np.arange(self.total_time_steps)
+        outputs = self._outputs[idx]
+        return {
+            "inputs": self._inputs[idx],
+            "outputs": outputs,
+            "active_entries": np.ones(outputs.shape[:-1], dtype=self.storage_dtype),
+            "identifier": self._identifier[idx],
+            "date": self._date[idx],
+        }
+
+    def test_data(self, tickers, test_boundary, test_end=None):
+        """Returns the (label encoded) test rows of an interval for fixed window batching."""
+        data = self.data
+        test = data[data["ticker"].isin(tickers) & (data["year"] >= test_boundary)]
+        if test_end:
+            test = test[test["year"] < test_end]
+        return test
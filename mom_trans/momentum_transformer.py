@@ -1,7 +1,7 @@
 """Many components in this file are adapted from https://github.com/google-research/google-research/tree/master/tft"""
 import tensorflow as tf
 from tensorflow import keras
-import gc
+import os
 import numpy as np
 
 concat = keras.backend.concatenate
@@ -16,6 +16,8 @@ Activation = keras.layers.Activation
 Lambda = keras.layers.Lambda
 
 from mom_trans.deep_momentum_network import DeepMomentumNetworkModel, SharpeLoss
+from mom_trans.chunked_attention import chunked_causal_attention
+from mom_trans.sequence_constants import causal_attention_bias, causal_mask
 from settings.hp_grid import (
     HP_DROPOUT_RATE,
     HP_HIDDEN_LAYER_SIZE,
@@ -125,6 +127,39 @@ def add_and_norm(x_list):
     return tmp
 
 
+class RecomputeGrad(keras.layers.Layer):
+    """Applies a sub-model without storing its activations for the backward
+    pass, which recomputes them instead (tf.recompute_grad). The sub-model must
+    be deterministic, so dropout is applied outside of it.
+    Attributes:
+        block: Sub-model to apply
+    """
+
+    def __init__(self, block: keras.Model, **kwargs):
+        super().__init__(**kwargs)
+        self.block = block
+
+    def call(self, inputs):
+        return tf.recompute_grad(lambda *x: self.block(list(x)))(*inputs)
+
+
+def apply_block(fn, inputs, recompute: bool = False):
+    """Applies fn to a list of inputs, optionally as a sub-model whose
+    activations are recomputed in the backward pass. The sub-models change the
+    layout of the weights, so checkpoints do not load across the two settings.
+    Args:
+        fn: Function of the inputs, building the layers of the block
+        inputs: List of batch first inputs
+        recompute: Whether to recompute the activations in the backward pass
+    Returns:
+        Outputs of fn
+    """
+    if not recompute:
+        return fn(*inputs)
+    block_inputs = [keras.layers.Input(x.shape[1:], dtype=x.dtype) for x in inputs]
+    return RecomputeGrad(keras.Model(block_inputs, fn(*block_inputs)))(inputs)
+
+
 def gated_residual_network(
     x,
     hidden_layer_size: int,
@@ -133,6 +168,7 @@ def gated_residual_network(
     use_time_distributed: bool = True,
     additional_context=None,
     return_gate: bool = False,
+    recompute: bool = False,
 ):
     """Applies the gated residual network (GRN) as defined in paper.
     Args:
@@ -143,6 +179,7 @@ def gated_residual_network(
         use_time_distributed: Whether to apply network across time dimension
         additional_context: Additional context vector to use if relevant
         return_gate: Whether to return GLU gate for diagnostic purposes
+        recompute: Whether to recompute the activations in the backward pass
     Returns:
         Tuple of tensors for: (GRN output, GLU gate)
     """
@@ -158,33 +195,163 @@ def gated_residual_network(
         skip = linear(x)
 
     # Apply feedforward network
-    hidden = linear_layer(
-        hidden_layer_size, activation=None, use_time_distributed=use_time_distributed
-    )(x)
-    if additional_context is not None:
-        hidden = hidden + linear_layer(
+    def feedforward(x, additional_context=None):
+        hidden = linear_layer(
             hidden_layer_size,
             activation=None,
             use_time_distributed=use_time_distributed,
-            use_bias=False,
-        )(additional_context)
-    hidden = keras.layers.Activation("elu")(hidden)
-    hidden = linear_layer(
-        hidden_layer_size, activation=None, use_time_distributed=use_time_distributed
-    )(hidden)
-
-    gating_layer, gate = apply_gating_layer(
-        hidden,
-        output_size,
-        dropout_rate=dropout_rate,
-        use_time_distributed=use_time_distributed,
-        activation=None,
-    )
+        )(x)
+        if additional_context is not None:
+            hidden = hidden + linear_layer(
+                hidden_layer_size,
+                activation=None,
+                use_time_distributed=use_time_distributed,
+                use_bias=False,
+            )(additional_context)
+        hidden = keras.layers.Activation("elu")(hidden)
+        return linear_layer(
+            hidden_layer_size,
+            activation=None,
+            use_time_distributed=use_time_distributed,
+        )(hidden)
 
-    if return_gate:
+    def gated_skip_connection(hidden, skip):
+        gating_layer, gate = apply_gating_layer(
+            hidden,
+            output_size,
+            use_time_distributed=use_time_distributed,
+            activation=None,
+        )
         return add_and_norm([skip, gating_layer]), gate
+
+    feedforward_inputs = [x] if additional_context is None else [x, additional_context]
+    hidden = apply_block(feedforward, feedforward_inputs, recompute)
+    if dropout_rate is not None:
+        hidden = keras.layers.Dropout(dropout_rate)(hidden)
+    outputs, gate = apply_block(gated_skip_connection, [hidden, skip], recompute)
+
+    if return_gate:
+        return outputs, gate
     else:
-        return add_and_norm([skip, gating_layer])
+        return outputs
+
+
+class GroupedDense(keras.layers.Layer):
+    """Defines block-diagonal dense layer, applying separate weights to each
+    group (e.g. input variable) in one batched matmul.
+    Attributes:
+        units: Output size per group
+        activation: Activation function to apply if required
+        use_bias: Whether bias should be included in layer
+    """
+
+    def __init__(self, units: int, activation=None, use_bias: bool = True, **kwargs):
+        super().__init__(**kwargs)
+        self.units = units
+        self.activation = keras.activations.get(activation)
+        self.use_bias = use_bias
+
+    def build(self, input_shape):
+        num_groups, input_dim = int(input_shape[-2]), int(input_shape[-1])
+        # same scale as glorot_uniform on each (input_dim, units) block
+        limit = np.sqrt(6.0 / (input_dim + self.units))
+        self.kernel = self.add_weight(
+            "kernel",
+            shape=(num_groups, input_dim, self.units),
+            initializer=keras.initializers.RandomUniform(-limit, limit),
+        )
+        if self.use_bias:
+            self.bias = self.add_weight(
+                "bias", shape=(num_groups, self.units), initializer="zeros"
+            )
+        super().build(input_shape)
+
+    def call(self, inputs):
+        """Applies layer.
+        Args:
+            inputs: Inputs of shape=(..., num_groups, input_dim)
+        Returns:
+            Outputs of shape=(..., num_groups, units)
+        """
+        num_groups, input_dim = inputs.shape[-2], inputs.shape[-1]
+        # shape=(num_groups, ?, input_dim), so one matmul is batched over groups.
+        # Faster than einsum with an ellipsis, which broadcasts the kernel.
+        x = tf.transpose(tf.reshape(inputs, [-1, num_groups, input_dim]), [1, 0, 2])
+        outputs = tf.transpose(tf.matmul(x, self.kernel), [1, 0, 2])
+        if self.use_bias:
+            outputs += self.bias
+        outputs = tf.reshape(
+            outputs, tf.concat([tf.shape(inputs)[:-1], [self.units]], axis=0)
+        )
+        outputs.set_shape(inputs.shape[:-1].concatenate([self.units]))
+        return self.activation(outputs)
+
+
+class GroupedLayerNormalization(keras.layers.Layer):
+    """Defines layer normalisation over the last axis, with separate scale and
+    offset for each group."""
+
+    def __init__(self, epsilon: float = 1e-3, **kwargs):
+        super().__init__(**kwargs)
+        self.epsilon = epsilon
+
+    def build(self, input_shape):
+        shape = (int(input_shape[-2]), int(input_shape[-1]))
+        # statistics are computed in full precision, so keep the weights there
+        self.gamma = self.add_weight(
+            "gamma", shape=shape, initializer="ones", experimental_autocast=False
+        )
+        self.beta = self.add_weight(
+            "beta", shape=shape, initializer="zeros", experimental_autocast=False
+        )
+        super().build(input_shape)
+
+    def call(self, inputs):
+        x = tf.cast(inputs, tf.float32)
+        mean, variance = tf.nn.moments(x, axes=[-1], keepdims=True)
+        outputs = tf.nn.batch_normalization(
+            x, mean, variance, self.beta, self.gamma, self.epsilon
+        )
+        return tf.cast(outputs, inputs.dtype)
+
+
+def grouped_gated_residual_network(
+    x,
+    hidden_layer_size: int,
+    dropout_rate: float = None,
+    recompute: bool = False,
+):
+    """Applies a separate gated residual network (GRN) to each group at once,
+    equivalent to one gated_residual_network per group without output_size.
+    Args:
+        x: Network inputs of shape=(..., num_groups, hidden_layer_size)
+        hidden_layer_size: Internal state size
+        dropout_rate: Dropout rate if dropout is applied
+        recompute: Whether to recompute the activations in the backward pass
+    Returns:
+        Tensor of GRN outputs of shape=(..., num_groups, hidden_layer_size)
+    """
+
+    def feedforward(x):
+        hidden = GroupedDense(hidden_layer_size)(x)
+        hidden = keras.layers.Activation("elu")(hidden)
+        return GroupedDense(hidden_layer_size)(hidden)
+
+    # Gated linear unit
+    def gated_skip_connection(hidden, x):
+        gating_layer = keras.layers.multiply(
+            [
+                GroupedDense(hidden_layer_size)(hidden),
+                GroupedDense(hidden_layer_size, activation="sigmoid")(hidden),
+            ]
+        )
+        tmp = keras.layers.Add()([x, gating_layer])
+        return GroupedLayerNormalization()(tmp)
+
+    hidden = apply_block(feedforward, [x], recompute)
+    if dropout_rate is not None:
+        hidden = keras.layers.Dropout(dropout_rate)(hidden)
+    return apply_block(gated_skip_connection, [hidden, x], recompute)
 
 
 # Attention Components.
@@ -193,10 +360,15 @@ def get_decoder_mask(self_attn_inputs):
     Args:
         self_attn_inputs: Inputs to self attention layer to determine mask shape
     """
-    len_s = tf.shape(self_attn_inputs)[-2]
+    len_s = self_attn_inputs.shape[-2]
     bs = tf.shape(self_attn_inputs)[:-2]
-    mask = tf.cumsum(tf.eye(len_s, batch_shape=bs), -2)
-    return mask
+    if len_s is None:  # unknown number of steps
+        len_s = tf.shape(self_attn_inputs)[-2]
+        return tf.cumsum(
+            tf.eye(len_s, batch_shape=bs, dtype=self_attn_inputs.dtype), -2
+        )
+    mask = tf.constant(causal_mask(len_s), dtype=self_attn_inputs.dtype)
+    return tf.broadcast_to(mask, tf.concat([bs, [len_s, len_s]], axis=0))
 
 
 class ScaledDotProductAttention(keras.layers.Layer):
@@ -223,7 +395,7 @@ class ScaledDotProductAttention(keras.layers.Layer):
         """
         attn = Lambda(tempering_batchdot)([q, k])  # shape=(batch, q, k)
         if mask is not None:
-            mmask = Lambda(lambda x: (-1e9) * (1.0 - tf.cast(x, "float32")))(
+            mmask = Lambda(lambda x: (-1e9) * (1.0 - tf.cast(x, attn.dtype)))(
                 mask
             )  # setting to infinity
             attn = keras.layers.add([attn, mmask])
@@ -235,10 +407,82 @@ class ScaledDotProductAttention(keras.layers.Layer):
 
 def tempering_batchdot(input_list):
     d, k = input_list
-    temper = tf.sqrt(tf.cast(k.shape[-1], dtype="float32"))
+    temper = tf.sqrt(tf.cast(k.shape[-1], dtype=d.dtype))
     return K.batch_dot(d, k, axes=[2, 2]) / temper
 
 
+class MultiHeadScaledDotProductAttention(keras.layers.Layer):
+    """Defines scaled dot product attention for all heads at once, with
+    queries and keys projected per head and values shared between heads."""
+
+    def __init__(self, n_head: int, **kwargs):
+        super().__init__(**kwargs)
+        self.n_head = n_head
+
+    def call(self, inputs, causal=False):
+        """Applies scaled dot product attention.
+        Args:
+            inputs: List of queries of shape=(?, T_q, n_head * d_k), keys of
+                shape=(?, T, n_head * d_k), values of shape=(?, T, d_v) and
+                optionally the mask of shape=(?, T_q, T)
+            causal: Whether to apply the (precomputed) causal mask instead, for
+                queries aligned with the final keys
+        Returns:
+            Tuple of (heads of shape=(n_head, ?, T_q, d_v), attention weights of
+            shape=(n_head, ?, T_q, T))
+        """
+        qs, ks, vs = inputs[:3]
+        d_k = qs.shape[-1] // self.n_head
+        qs = self.split_heads(qs)
+        ks = self.split_heads(ks)
+
+        temper = tf.sqrt(tf.cast(d_k, dtype=qs.dtype))
+        attn = tf.matmul(qs, ks, transpose_b=True) / temper  # batched over heads
+        if causal:
+            attn += causal_attention_bias(
+                inputs[0].shape[-2], inputs[1].shape[-2], attn.dtype
+            )
+        elif len(inputs) > 3:
+            # setting to infinity
+            attn += (-1e9) * (1.0 - tf.cast(inputs[3], attn.dtype))
+        attn = tf.nn.softmax(attn)
+        heads = tf.matmul(attn, vs[tf.newaxis])  # values shared by all heads
+        return heads, attn
+
+    def split_heads(self, x):
+        """Returns x of shape=(?, T, n_head * d_k) with shape=(n_head, ?, T, d_k)."""
+        d_k = x.shape[-1] // self.n_head
+        head_shape = tf.concat([tf.shape(x)[:-1], [self.n_head, d_k]], axis=0)
+        return tf.transpose(tf.reshape(x, head_shape), [2, 0, 1, 3])
+
+
+class ChunkedMultiHeadCausalAttention(MultiHeadScaledDotProductAttention):
+    """Defines causal scaled dot product attention for all heads at once,
+    computed chunk_size steps at a time so that memory is linear in T. The
+    attention weights are never materialised, so only the heads are returned."""
+
+    def __init__(self, n_head: int, chunk_size: int, **kwargs):
+        super().__init__(n_head, **kwargs)
+        self.chunk_size = chunk_size
+
+    def call(self, inputs):
+        """Applies causal scaled dot product attention.
+        Args:
+            inputs: List of queries and keys of shape=(?, T, n_head * d_k) and
+                values of shape=(?, T, d_v)
+        Returns:
+            Heads of shape=(n_head, ?, T, d_v)
+        """
+        qs, ks, vs = inputs
+        time_steps = qs.shape[-2]
+        qs = self.split_heads(qs)
+        ks = self.split_heads(ks)
+        vs = tf.tile(vs[tf.newaxis], [self.n_head, 1, 1, 1])
+        for x in [qs, ks, vs]:
+            x.set_shape([self.n_head, None, time_steps, x.shape[-1]])
+        return chunked_causal_attention(qs, ks, vs, self.chunk_size)
+
+
 class InterpretableMultiHeadAttention(keras.layers.Layer):
     """Defines interpretable multi-head attention layer.
     Attributes:
@@ -246,42 +490,55 @@ class InterpretableMultiHeadAttention(keras.layers.Layer):
         d_k: Key/query dimensionality per head
         d_v: Value dimensionality
         dropout: Dropout rate to apply
-        qs_layers: List of queries across heads
-        ks_layers: List of keys across heads
-        vs_layers: List of values across heads
-        attention: Scaled dot product attention layer
+        qs_layer: Queries across heads, fused into one projection
+        ks_layer: Keys across heads, fused into one projection
+        vs_layer: Values, shared across heads
+        attention: Scaled dot product attention layer for all heads
+        chunked_attention: Chunked causal attention layer for all heads, if
+            chunk_size is set
         w_o: Output weight matrix to project internal state to the original TFT state size
+        recompute: Whether to recompute the attention in the backward pass
     """
 
-    def __init__(self, n_head: int, d_model: int, dropout: float, **kwargs):
+    def __init__(
+        self,
+        n_head: int,
+        d_model: int,
+        dropout: float,
+        chunk_size=None,
+        recompute: bool = False,
+        **kwargs
+    ):
         """Initialises layer.
         Args:
             n_head: Number of heads
             d_model: TFT state dimensionality
             dropout: Dropout discard rate
+            chunk_size: Steps per chunk of the causal attention, or None to
+                compute it at once
+            recompute: Whether to recompute the attention in the backward pass,
+                instead of storing the attention weights
         """
 
         super().__init__(**kwargs)
         self.n_head = n_head
+        self.recompute = recompute
         self.d_k = self.d_v = d_k = d_v = d_model // n_head
         self.dropout = dropout
 
-        self.qs_layers = []
-        self.ks_layers = []
-        self.vs_layers = []
-
+        # head i uses columns [i * d_k, (i + 1) * d_k) of the query and key kernels
+        self.qs_layer = keras.layers.Dense(n_head * d_k, use_bias=False)
+        self.ks_layer = keras.layers.Dense(n_head * d_k, use_bias=False)
         # Use same value layer to facilitate interp
-        vs_layer = keras.layers.Dense(d_v, use_bias=False)
+        self.vs_layer = keras.layers.Dense(d_v, use_bias=False)
 
-        for _ in range(n_head):
-            self.qs_layers.append(keras.layers.Dense(d_k, use_bias=False))
-            self.ks_layers.append(keras.layers.Dense(d_k, use_bias=False))
-            self.vs_layers.append(vs_layer)  # use same vs_layer
-
-        self.attention = ScaledDotProductAttention()
+        self.attention = MultiHeadScaledDotProductAttention(n_head)
+        self.chunked_attention = (
+            ChunkedMultiHeadCausalAttention(n_head, chunk_size) if chunk_size else None
+        )
         self.w_o = keras.layers.Dense(d_model, use_bias=False)
 
-    def __call__(self, q, k, v, mask=None):
+    def __call__(self, q, k, v, mask=None, causal=False):
         """Applies interpretable multihead attention.
         Using T to denote the number of time steps fed into the transformer.
         Args:
@@ -289,32 +546,154 @@ class InterpretableMultiHeadAttention(keras.layers.Layer):
             k: Key of shape=(?, T, d_model)
             v: Values of shape=(?, T, d_model)
             mask: Masking if required with shape=(?, T, T)
+            causal: Whether to apply the precomputed causal mask instead
         Returns:
             Tuple of (layer outputs, attention weights)
         """
-        n_head = self.n_head
-
-        heads = []
-        attns = []
-        for i in range(n_head):
-            qs = self.qs_layers[i](q)
-            ks = self.ks_layers[i](k)
-            vs = self.vs_layers[i](v)
-            head, attn = self.attention(qs, ks, vs, mask)
-
-            head_dropout = keras.layers.Dropout(self.dropout)(head)
-            heads.append(head_dropout)
-            attns.append(attn)
-        head = Lambda(tf_stack)(heads) if n_head > 1 else heads[0]
-        attn = Lambda(tf_stack)(attns)
-
-        outputs = Lambda(K.mean, arguments={"axis": 0})(head) if n_head > 1 else head
+
+        def attention_heads(q, k, v, *mask):
+            qs = self.qs_layer(q)
+            ks = self.ks_layer(k)
+            vs = self.vs_layer(v)
+            heads, attn = self.attention([qs, ks, vs, *mask], causal=causal)
+            if causal and self.chunked_attention is not None:
+                # the full attention weights are then only computed for
+                # interpretation, not by the model itself
+                heads = self.chunked_attention([qs, ks, vs])
+            return heads, attn
+
+        # chunked attention already recomputes its blocks in the backward pass
+        heads, attn = apply_block(
+            attention_heads,
+            [q, k, v] if mask is None else [q, k, v, mask],
+            self.recompute and self.chunked_attention is None,
+        )
+
+        heads = keras.layers.Dropout(self.dropout)(heads)
+        outputs = Lambda(K.mean, arguments={"axis": 0})(heads)
         outputs = self.w_o(outputs)
         outputs = keras.layers.Dropout(self.dropout)(outputs)  # output dropout
 
         return outputs, attn
 
 
+class IncrementalTftPredictor:
+    """Computes TFT positions one day at a time, e.g. for end of day scoring of
+    every ticker at once (one ticker per batch row).
+
+    The LSTM state and the attention keys and values of the last T steps are
+    cached, so each new day only runs the network for that day. The positions
+    from warm_up match the windowed model. Later steps carry the LSTM state
+    forward rather than restarting it at the start of each window, so they
+    approximate the windowed model, attending over the last T steps.
+
+    Attributes:
+        time_steps: Number of steps attended over (T)
+        states: Cached LSTM states [h, c]
+        keys: Cached attention keys of shape=(?, T, n_head * d_k)
+        values: Cached attention values of shape=(?, T, d_v)
+    """
+
+    def __init__(
+        self,
+        variable_selection,
+        lstm,
+        static_enrichment,
+        attention,
+        decoder,
+        time_steps,
+    ):
+        """Initialises predictor from the layers of a TFT model.
+        Args:
+            variable_selection: Sub-model for the layers before the LSTM
+            lstm: LSTM layer, returning its states
+            static_enrichment: Sub-model for the layers between the LSTM and
+                self attention
+            attention: Interpretable multi-head attention layer
+            decoder: Sub-model for the position-wise layers after self attention
+            time_steps: Number of steps attended over
+        """
+        self.variable_selection = variable_selection
+        self.lstm = lstm
+        self.static_enrichment = static_enrichment
+        self.attention = attention
+        self.decoder = decoder
+        self.time_steps = time_steps
+
+        self.states = None
+        self.keys = None
+        self.values = None
+        self._run_function = tf.function(self._run)
+
+    def _run(self, inputs, states=None, keys=None, values=None):
+        """Runs the network over new steps, extending the cached keys and values."""
+        (
+            input_embeddings,
+            _,
+            _,
+            state_h,
+            state_c,
+            static_context_enrichment,
+        ) = self.variable_selection(inputs, training=False)
+        if states is None:
+            states = [state_h, state_c]
+        lstm_outputs, state_h, state_c = self.lstm(
+            input_embeddings, initial_state=states, training=False
+        )
+        enriched, temporal_features = self.static_enrichment(
+            [lstm_outputs, input_embeddings, static_context_enrichment],
+            training=False,
+        )
+
+        new_keys = self.attention.ks_layer(enriched)
+        new_values = self.attention.vs_layer(enriched)
+        if keys is not None:
+            new_keys = tf.concat([keys, new_keys], axis=1)
+            new_values = tf.concat([values, new_values], axis=1)
+        keys = new_keys[:, -self.time_steps :]
+        values = new_values[:, -self.time_steps :]
+
+        # final query only, which attends to every cached step
+        heads, _ = self.attention.attention(
+            [self.attention.qs_layer(enriched[:, -1:]), keys, values]
+        )
+        attention_outputs = self.attention.w_o(tf.reduce_mean(heads, axis=0))
+        outputs = self.decoder(
+            [attention_outputs, enriched[:, -1:], temporal_features[:, -1:]],
+            training=False,
+        )
+        return outputs[:, -1, 0], [state_h, state_c], keys, values
+
+    def warm_up(self, inputs: np.array) -> np.array:
+        """Fills the cache from a full window of each ticker.
+        Args:
+            inputs: Inputs of shape=(?, T, input_size)
+        Returns:
+            Positions for the final step of each window
+        """
+        positions, self.states, self.keys, self.values = self._run_function(
+            tf.convert_to_tensor(inputs, dtype=tf.float32)
+        )
+        return positions.numpy()
+
+    def step(self, inputs: np.array) -> np.array:
+        """Computes positions for the next day and rolls the cache forward.
+        Args:
+            inputs: Inputs of the new day of shape=(?, input_size)
+        Returns:
+            Positions for the new day
+        """
+        if self.states is None:
+            raise ValueError("Call warm_up before step.")
+        positions, self.states, self.keys, self.values = self._run_function(
+            tf.convert_to_tensor(inputs, dtype=tf.float32)[:, tf.newaxis],
+            self.states,
+            self.keys,
+            self.values,
+        )
+        return positions.numpy()
+
+
 class TftDeepMomentumNetworkModel(DeepMomentumNetworkModel):
     def __init__(self, project_name, hp_directory, hp_minibatch_size=HP_MINIBATCH_SIZE, **params):
         params = params.copy()
@@ -322,6 +701,7 @@ class TftDeepMomentumNetworkModel(DeepMomentumNetworkModel):
         self._input_placeholder = None
         self._attention_components = None
         self._prediction_parts = None
+        self._incremental_predictor = None  # (model, predictor)
 
         # self._input_obs_loc = params["input_obs_loc"]
         self._static_input_loc = params["static_input_loc"]
@@ -335,6 +715,9 @@ class TftDeepMomentumNetworkModel(DeepMomentumNetworkModel):
         self.num_stacks = params["stack_size"]
         self.num_heads = params["num_heads"]
         self.input_size = int(params["input_size"])
+        # recompute GRN and attention activations in the backward pass, so that
+        # larger minibatches fit in memory
+        self.recompute_gradients = params.get("recompute_gradients", False)
 
         super().__init__(project_name, hp_directory, hp_minibatch_size, **params)
 
@@ -359,13 +742,16 @@ class TftDeepMomentumNetworkModel(DeepMomentumNetworkModel):
             ),
             name="input",
         )
+        # any number of steps, so the layers up to the LSTM can also be applied
+        # one step at a time (see IncrementalTftPredictor)
+        step_inputs = keras.layers.Input(shape=(None, combined_input_size))
 
         (
             unknown_inputs,
             known_combined_layer,
             # obs_inputs,
             static_inputs,
-        ) = self.get_tft_embeddings(all_inputs)
+        ) = self.get_tft_embeddings(step_inputs)
 
         if unknown_inputs is not None:
             historical_inputs = concat(
@@ -416,20 +802,11 @@ class TftDeepMomentumNetworkModel(DeepMomentumNetworkModel):
                 sparse_weights
             )
 
-            trans_emb_list = []
-            for i in range(num_static):
-                e = gated_residual_network(
-                    embedding[:, i : i + 1, :],
-                    self.hidden_layer_size,
-                    dropout_rate=self.dropout_rate,
-                    use_time_distributed=False,
-                )
-                trans_emb_list.append(e)
-
-            transformed_embedding = (
-                keras.layers.Concatenate(axis=1)(trans_emb_list)
-                if len(trans_emb_list) > 1
-                else trans_emb_list[0]
+            # One GRN per static variable, applied together
+            transformed_embedding = grouped_gated_residual_network(
+                embedding,
+                self.hidden_layer_size,
+                dropout_rate=self.dropout_rate,
             )
 
             combined = keras.layers.multiply([sparse_weights, transformed_embedding])
@@ -476,12 +853,12 @@ class TftDeepMomentumNetworkModel(DeepMomentumNetworkModel):
             """
 
             # Add temporal features
-            time_steps, embedding_dim, num_inputs = embedding.get_shape().as_list()[-3:]
+            embedding_dim, num_inputs = embedding.get_shape().as_list()[-2:]
 
-            batch_dimensions = tf.shape(embedding)[:-3]
+            batch_dimensions = tf.shape(embedding)[:-2]
             # new_shape = [-1, time_steps, embedding_dim * num_inputs]
             new_shape = tf.concat(
-                [batch_dimensions, [time_steps, embedding_dim * num_inputs]], axis=-1
+                [batch_dimensions, [embedding_dim * num_inputs]], axis=-1
             )
             flatten = tf.reshape(embedding, shape=new_shape)
 
@@ -501,6 +878,7 @@ class TftDeepMomentumNetworkModel(DeepMomentumNetworkModel):
                 use_time_distributed=True,
                 additional_context=expanded_static_context,
                 return_gate=True,
+                recompute=self.recompute_gradients,
             )
 
             sparse_weights = keras.layers.Activation("softmax")(mlp_outputs)
@@ -508,20 +886,15 @@ class TftDeepMomentumNetworkModel(DeepMomentumNetworkModel):
                 sparse_weights
             )
 
-            # Non-linear Processing & weight application
-            trans_emb_list = []
-            for i in range(num_inputs):
-                grn_output = gated_residual_network(
-                    embedding[..., i],
-                    self.hidden_layer_size,
-                    dropout_rate=self.dropout_rate,
-                    use_time_distributed=True,
-                )
-                trans_emb_list.append(grn_output)
-
-            transformed_embedding = Lambda(tf_stack, arguments={"axis": -1})(
-                trans_emb_list
+            # Non-linear Processing & weight application, one GRN per variable
+            # applied together on shape=(?, T, num_inputs, embedding_dim)
+            transformed_embedding = grouped_gated_residual_network(
+                tf.linalg.matrix_transpose(embedding),
+                self.hidden_layer_size,
+                dropout_rate=self.dropout_rate,
+                recompute=self.recompute_gradients,
             )
+            transformed_embedding = tf.linalg.matrix_transpose(transformed_embedding)
 
             combined = keras.layers.multiply([sparse_weights, transformed_embedding])
             temporal_ctx = Lambda(K.sum, arguments={"axis": -1})(combined)
@@ -530,6 +903,27 @@ class TftDeepMomentumNetworkModel(DeepMomentumNetworkModel):
 
         input_embeddings, flags, _ = lstm_combine_and_mask(historical_inputs)
 
+        variable_selection = keras.Model(
+            inputs=step_inputs,
+            outputs=[
+                input_embeddings,
+                flags,
+                static_weights,
+                static_context_state_h,
+                static_context_state_c,
+                static_context_enrichment,
+            ],
+            name="variable_selection",
+        )
+        (
+            input_embeddings,
+            flags,
+            static_weights,
+            static_context_state_h,
+            static_context_state_c,
+            static_context_enrichment,
+        ) = variable_selection(all_inputs)
+
         # LSTM layer
         def get_lstm(return_state):
             """Returns LSTM cell initialized with default parameters."""
@@ -548,19 +942,33 @@ class TftDeepMomentumNetworkModel(DeepMomentumNetworkModel):
             )
             return lstm
 
-        lstm_layer = get_lstm(return_state=False)(
+        # the final states seed the incremental predictor
+        lstm = get_lstm(return_state=True)
+        lstm_layer, _, _ = lstm(
             input_embeddings,
             initial_state=[static_context_state_h, static_context_state_c],
         )
 
-        lstm_layer, _ = apply_gating_layer(
-            lstm_layer, self.hidden_layer_size, self.dropout_rate, activation=None
+        # Position-wise layers between the LSTM and self attention
+        temporal_inputs = [
+            keras.layers.Input((None, self.hidden_layer_size), dtype=lstm_layer.dtype),
+            keras.layers.Input(
+                (None, self.hidden_layer_size), dtype=input_embeddings.dtype
+            ),
+            keras.layers.Input(
+                (self.hidden_layer_size,), dtype=static_context_enrichment.dtype
+            ),
+        ]
+        temporal_lstm, temporal_embeddings, enrichment_context = temporal_inputs
+
+        temporal_lstm, _ = apply_gating_layer(
+            temporal_lstm, self.hidden_layer_size, self.dropout_rate, activation=None
         )
-        temporal_feature_layer = add_and_norm([lstm_layer, input_embeddings])
+        temporal_feature_layer = add_and_norm([temporal_lstm, temporal_embeddings])
 
         # Static enrichment layers
         expanded_static_context = Lambda(tf.expand_dims, arguments={"axis": -2})(
-            static_context_enrichment
+            enrichment_context
         )
         enriched, _ = gated_residual_network(
             temporal_feature_layer,
@@ -569,34 +977,59 @@ class TftDeepMomentumNetworkModel(DeepMomentumNetworkModel):
             use_time_distributed=True,
             additional_context=expanded_static_context,
             return_gate=True,
+            recompute=self.recompute_gradients,
+        )
+
+        static_enrichment = keras.Model(
+            inputs=temporal_inputs,
+            outputs=[enriched, temporal_feature_layer],
+            name="static_enrichment",
+        )
+        enriched, temporal_feature_layer = static_enrichment(
+            [lstm_layer, input_embeddings, static_context_enrichment]
         )
 
         # Decoder self attention
         self_attn_layer = InterpretableMultiHeadAttention(
-            self.num_heads, self.hidden_layer_size, dropout=self.dropout_rate
+            self.num_heads,
+            self.hidden_layer_size,
+            dropout=self.dropout_rate,
+            chunk_size=self.attention_chunk_size,
+            recompute=self.recompute_gradients,
         )
 
-        mask = get_decoder_mask(enriched)
-        x, self_att = self_attn_layer(enriched, enriched, enriched, mask=mask)
-        
-        x, _ = apply_gating_layer(
-            x, self.hidden_layer_size, dropout_rate=self.dropout_rate, activation=None
+        x, self_att = self_attn_layer(enriched, enriched, enriched, causal=True)
+
+        # Position-wise layers after self attention, as a sub-model so that the
+        # last step model below can share them
+        decoder_inputs = [
+            keras.layers.Input((None, self.hidden_layer_size), dtype=enriched.dtype)
+            for _ in range(3)
+        ]
+        attention_output, decoder_enriched, decoder_temporal = decoder_inputs
+
+        decoder, _ = apply_gating_layer(
+            attention_output,
+            self.hidden_layer_size,
+            dropout_rate=self.dropout_rate,
+            activation=None,
         )
-        x = add_and_norm([x, enriched])
+        decoder = add_and_norm([decoder, decoder_enriched])
 
         # Nonlinear processing on outputs
         decoder = gated_residual_network(
-            x,
+            decoder,
             self.hidden_layer_size,
             dropout_rate=self.dropout_rate,
             use_time_distributed=True,
+            recompute=self.recompute_gradients,
         )
 
         # Final skip connection
         decoder, _ = apply_gating_layer(
             decoder, self.hidden_layer_size, activation=None
         )
-        transformer_layer = add_and_norm([decoder, temporal_feature_layer])
+        transformer_layer = add_and_norm([decoder, decoder_temporal])
 
         # Attention components for explainability
         attention_components = {
@@ -610,23 +1043,30 @@ class TftDeepMomentumNetworkModel(DeepMomentumNetworkModel):
         }
 
         if self.force_output_sharpe_length:
-            outputs = keras.layers.TimeDistributed(
+            decoder_outputs = keras.layers.TimeDistributed(
                 keras.layers.Dense(
                     self.output_size,
                     activation=tf.nn.tanh,
                     kernel_constraint=keras.constraints.max_norm(3),
+                    dtype="float32",  # outputs in full precision for the loss
                 )
             )(transformer_layer[Ellipsis, -self.force_output_sharpe_length:, :])
         else:
-            outputs = keras.layers.TimeDistributed(
+            decoder_outputs = keras.layers.TimeDistributed(
                 keras.layers.Dense(
                     # self.output_size,
                     1,
                     activation="sigmoid",
                     kernel_constraint=keras.constraints.max_norm(3),
+                    dtype="float32",  # outputs in full precision for the loss
                 )
             )(transformer_layer[Ellipsis, :, :])
 
+        position_wise_decoder = keras.Model(
+            inputs=decoder_inputs, outputs=decoder_outputs, name="decoder"
+        )
+        outputs = position_wise_decoder([x, enriched, temporal_feature_layer])
+
         self._attention_components = attention_components
 
         adam = keras.optimizers.Adam(
@@ -634,6 +1074,30 @@ class TftDeepMomentumNetworkModel(DeepMomentumNetworkModel):
         )
 
         model = keras.Model(inputs=all_inputs, outputs=outputs)
+        self._incremental_predictor = (
+            model,
+            IncrementalTftPredictor(
+                variable_selection,
+                lstm,
+                static_enrichment,
+                self_attn_layer,
+                position_wise_decoder,
+                time_steps,
+            ),
+        )
+
+        if self.last_step_inference:
+            # Only the final query row, which attends to every step, so needs
+            # no mask. Shares all weights with the full model.
+            last_enriched = enriched[:, -1:, :]
+            last_x, _ = self_attn_layer(last_enriched, enriched, enriched)
+            last_step_outputs = position_wise_decoder(
+                [last_x, last_enriched, temporal_feature_layer[:, -1:, :]]
+            )
+            self._last_step_model = (
+                model,
+                keras.Model(inputs=all_inputs, outputs=last_step_outputs),
+            )
 
         # sharpe_loss = SharpeLoss(self.output_size).call
 
@@ -656,8 +1120,6 @@ class TftDeepMomentumNetworkModel(DeepMomentumNetworkModel):
           Tensors for transformed inputs.
         """
 
-        time_steps = self.time_steps
-
         # Sanity checks
         # for i in self._known_regular_input_idx:
         #     if i in self._input_obs_loc:
@@ -685,11 +1147,10 @@ class TftDeepMomentumNetworkModel(DeepMomentumNetworkModel):
 
             embedding = keras.Sequential(
                 [
-                    keras.layers.InputLayer([time_steps]),
+                    keras.layers.InputLayer([None]),  # any number of steps
                     keras.layers.Embedding(
                         self.category_counts[i],
                         embedding_sizes[i],
-                        input_length=time_steps,
                         dtype=tf.float32,
                     ),
                 ]
@@ -706,30 +1167,64 @@ class TftDeepMomentumNetworkModel(DeepMomentumNetworkModel):
             for i in range(num_categorical_variables)
         ]
 
+        def convert_real_to_embedding(x):
+            """Applies linear transformation for each real input at once.
+
+            Args:
+                x: Real inputs of shape=(..., num_variables)
+
+            Returns:
+                Embeddings of shape=(..., num_variables, hidden_layer_size)
+            """
+            return GroupedDense(self.hidden_layer_size)(x[..., tf.newaxis])
+
+        def stack_embeddings(regular_idx, categorical_list):
+            """Stacks time-varying real and categorical embeddings on the last axis."""
+            embedding_list = (
+                [
+                    tf.linalg.matrix_transpose(
+                        convert_real_to_embedding(
+                            tf.gather(regular_inputs, regular_idx, axis=-1)
+                        )
+                    )
+                ]
+                if regular_idx
+                else []
+            ) + (
+                [keras.backend.stack(categorical_list, axis=-1)]
+                if categorical_list
+                else []
+            )
+            return concat(embedding_list, axis=-1) if embedding_list else None
+
         # Static inputs
         if self._static_input_loc:
-            static_inputs = [
-                keras.layers.Dense(self.hidden_layer_size)(
-                    regular_inputs[:, 0, i : i + 1]
-                )
-                for i in range(num_regular_variables)
-                if i in self._static_input_loc
-            ] + [
+            static_regular_idx = [
+                i for i in range(num_regular_variables) if i in self._static_input_loc
+            ]
+            static_categorical_inputs = [
                 embedded_inputs[i][:, 0, :]
                 for i in range(num_categorical_variables)
                 if i + num_regular_variables in self._static_input_loc
             ]
-            static_inputs = keras.backend.stack(static_inputs, axis=1)
+            static_inputs = (
+                [
+                    convert_real_to_embedding(
+                        tf.gather(regular_inputs[:, 0], static_regular_idx, axis=-1)
+                    )
+                ]
+                if static_regular_idx
+                else []
+            ) + (
+                [keras.backend.stack(static_categorical_inputs, axis=1)]
+                if static_categorical_inputs
+                else []
+            )
+            static_inputs = concat(static_inputs, axis=1)
 
         else:
             static_inputs = None
 
-        def convert_real_to_embedding(x):
-            """Applies linear transformation for time-varying inputs."""
-            return keras.layers.TimeDistributed(
-                keras.layers.Dense(self.hidden_layer_size)
-            )(x)
-
         # Targets
         # obs_inputs = keras.backend.stack(
         #     [
@@ -750,24 +1245,17 @@ class TftDeepMomentumNetworkModel(DeepMomentumNetworkModel):
                 e = embeddings[i](categorical_inputs[:, :, i])
                 wired_embeddings.append(e)
 
-        unknown_inputs = []
-        for i in range(regular_inputs.shape[-1]):
-            if (
-                i not in self._known_regular_input_idx
-            ):  # and i not in self._input_obs_loc:
-                e = convert_real_to_embedding(regular_inputs[Ellipsis, i : i + 1])
-                unknown_inputs.append(e)
-
-        if unknown_inputs + wired_embeddings:
-            unknown_inputs = keras.backend.stack(
-                unknown_inputs + wired_embeddings, axis=-1
-            )
-        else:
-            unknown_inputs = None
+        unknown_regular_idx = [
+            i
+            for i in range(num_regular_variables)
+            if i not in self._known_regular_input_idx
+            # and i not in self._input_obs_loc
+        ]
+        unknown_inputs = stack_embeddings(unknown_regular_idx, wired_embeddings)
 
         # A priori known inputs
-        known_regular_inputs = [
-            convert_real_to_embedding(regular_inputs[Ellipsis, i : i + 1])
+        known_regular_idx = [
+            i
             for i in self._known_regular_input_idx
             if i not in self._static_input_loc
         ]
@@ -777,16 +1265,30 @@ class TftDeepMomentumNetworkModel(DeepMomentumNetworkModel):
             if i + num_regular_variables not in self._static_input_loc
         ]
 
-        known_combined_layer = keras.backend.stack(
-            known_regular_inputs + known_categorical_inputs, axis=-1
+        known_combined_layer = stack_embeddings(
+            known_regular_idx, known_categorical_inputs
         )
 
         return unknown_inputs, known_combined_layer, static_inputs
     
-    def get_attention(self, data, batch_size, mask = None):
+    def get_incremental_predictor(self, model) -> IncrementalTftPredictor:
+        """Returns the incremental predictor sharing the weights of `model`, which
+        must be the last model built by this network."""
+        if (
+            self._incremental_predictor is None
+            or self._incremental_predictor[0] is not model
+        ):
+            raise ValueError("Model was not the last one built by this network.")
+        return self._incremental_predictor[1]
+
+    def get_attention(self, data, batch_size, mask=None, directory=None):
         """Computes TFT attention weights for a given dataset.
         Args:
-          df: Input dataframe
+          data: Input data dictionary
+          batch_size: Number of samples per batch
+          mask: Boolean mask of samples to keep, if required
+          directory: If set, weights are written to memory mapped .npy files
+            here instead of being held in memory
         Returns:
             Dictionary of numpy arrays for temporal attention weights and variable
               selection weights, along with their identifiers and time indices
@@ -801,52 +1303,62 @@ class TftDeepMomentumNetworkModel(DeepMomentumNetworkModel):
             identifiers = data["identifier"]
             time = data["date"]
 
-        def get_batch_attention_weights(input_batch):
-            """Returns weights for a given minibatch of data."""
-            input_placeholder = self._input_placeholder
-            attention_weights = {}
+        # one extractor for all components, traced once for every batch size
+        components = {
+            k: v
+            for k, v in self._attention_components.items()
+            if not isinstance(v, list)  # no static inputs
+        }
+        extractor = tf.keras.Model(inputs=self._input_placeholder, outputs=components)
+        extract = tf.function(
+            lambda x: extractor(x, training=False),
+            input_signature=[
+                tf.TensorSpec((None,) + inputs.shape[1:], dtype=tf.float32)
+            ],
+        )
 
-            for k in self._attention_components:
-                extractor = tf.keras.Model(
-                    inputs=input_placeholder, outputs=self._attention_components[k]
-                )
-                attention_weight = extractor(input_batch.astype(np.float32))
-                attention_weights[k] = attention_weight
-            return attention_weights
+        if directory:
+            os.makedirs(directory, exist_ok=True)
 
-        # Compute number of batches
-        # batch_size = self.minibatch_size
+        # Stream batches into preallocated arrays, avoiding large memory increases
         n = inputs.shape[0]
-        num_batches = n // batch_size
-        if n - (num_batches * batch_size) > 0:
-            num_batches += 1
-
-        # Split up inputs into batches
-        batched_inputs = [
-            inputs[i * batch_size : (i + 1) * batch_size, Ellipsis]
-            for i in range(num_batches)
-        ]
-
-        # Get attention weights, while avoiding large memory increases
-        attention_by_batch = [
-            get_batch_attention_weights(batch) for batch in batched_inputs
-        ]
         attention_weights = {}
-        for k in self._attention_components:
-            attention_weights[k] = []
-            for batch_weights in attention_by_batch:
-                attention_weights[k].append(batch_weights[k])
-
-            if len(attention_weights[k][0].shape) == 4:
-                tmp = np.concatenate(attention_weights[k], axis=1)
-            else:
-                tmp = np.concatenate(attention_weights[k], axis=0)
-
-            del attention_weights[k]
-            gc.collect()
-            attention_weights[k] = tmp
-
+        for start in range(0, n, batch_size):
+            batch_weights = extract(
+                inputs[start : start + batch_size].astype(np.float32)
+            )
+            for k, weights in batch_weights.items():
+                weights = weights.numpy()
+                # decoder self attention has shape=(n_head, batch, T, T)
+                batch_axis = 1 if len(weights.shape) == 4 else 0
+                if k not in attention_weights:
+                    shape = list(weights.shape)
+                    shape[batch_axis] = n
+                    attention_weights[k] = (
+                        np.lib.format.open_memmap(
+                            os.path.join(directory, f"{k}.npy"),
+                            mode="w+",
+                            dtype=weights.dtype,
+                            shape=tuple(shape),
+                        )
+                        if directory
+                        else np.empty(shape, dtype=weights.dtype)
+                    )
+                index = [slice(None)] * len(weights.shape)
+                index[batch_axis] = slice(start, start + weights.shape[batch_axis])
+                attention_weights[k][tuple(index)] = weights
+
+        if directory:
+            for weights in attention_weights.values():
+                weights.flush()
         attention_weights["identifiers"] = identifiers[:, 0, 0]
         attention_weights["time"] = time[:, :, 0]
+        if directory:
+            for k in ["identifiers", "time"]:
+                np.save(
+                    os.path.join(directory, f"{k}.npy"),
+                    attention_weights[k],
+                    allow_pickle=True,
+                )
 
         return attention_weights
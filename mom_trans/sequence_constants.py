@@ -0,0 +1,55 @@
+"""Causal masks and position encodings, computed once per shape and reused by
+every model build and forward pass."""
+import functools
+
+import numpy as np
+import tensorflow as tf
+
+# added to the attention logits of masked steps
+MASK_VALUE = -1e9
+
+
+def _read_only(array: np.array) -> np.array:
+    """Cached arrays are shared, so must not be modified in place."""
+    array.setflags(write=False)
+    return array
+
+
+@functools.lru_cache(maxsize=None)
+def causal_mask(time_steps: int) -> np.array:
+    """Returns causal mask of shape=(time_steps, time_steps), with ones where the
+    query (row) may attend to the key (column)."""
+    return _read_only(np.tril(np.ones((time_steps, time_steps), dtype=np.float32)))
+
+
+@functools.lru_cache(maxsize=None)
+def _causal_attention_bias(query_steps: int, key_steps: int) -> np.array:
+    mask = causal_mask(key_steps)[key_steps - query_steps :]
+    return _read_only(MASK_VALUE * (1.0 - mask))
+
+
+def causal_attention_bias(query_steps: int, key_steps: int, dtype=tf.float32):
+    """Returns additive causal mask for queries aligned with the final keys.
+    Args:
+        query_steps: Number of query steps, at most key_steps
+        key_steps: Number of key steps
+        dtype: Dtype of the attention logits
+    Returns:
+        Tensor of shape=(query_steps, key_steps), 0 where attention is allowed and
+        MASK_VALUE elsewhere
+    """
+    return tf.constant(_causal_attention_bias(query_steps, key_steps), dtype=dtype)
+
+
+@functools.lru_cache(maxsize=None)
+def position_encoding(time_steps: int, d_model: int, n: int = 10000) -> np.array:
+    """Returns sinusoidal position encoding of shape=(time_steps, d_model), with
+    sines in the even and cosines in the odd dimensions."""
+    num_frequencies = d_model // 2
+    angles = np.arange(time_steps)[:, np.newaxis] / np.power(
+        n, 2 * np.arange(num_frequencies) / d_model
+    )
+    encoding = np.zeros((time_steps, d_model))
+    encoding[:, 0 : 2 * num_frequencies : 2] = np.sin(angles)
+    encoding[:, 1 : 2 * num_frequencies : 2] = np.cos(angles)
+    return _read_only(encoding)
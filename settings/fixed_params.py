@@ -7,8 +7,27 @@ MODLE_PARAMS = {
     "fill_blank_dates": False,
     "split_tickers_individually": True,
     "random_search_iterations": 5,
+    "tuner": "random_search",  # or "hyperband"
+    "hyperband_factor": 3,
+    "hyperband_iterations": 1,
     "evaluate_diversified_val_sharpe": False,
     "train_valid_ratio": 0.80,
     "time_features": False,
     "force_output_sharpe_length": 0,
+    "share_windows": False,
+    "storage_dtype": "float32",
+    "batching_workers": 1,
+    "parallel_trials": 1,
+    "warm_start": False,  # TFT and Transformer require share_windows
+    "warm_start_epochs": 50,
+    "warm_start_reuse_hyperparameters": False,
+    "jit_compile": False,
+    "mixed_precision": False,  # bfloat16, for LSTM and TFT
+    "profile_training": False,
+    "save_attention": False,  # TFT only
+    "last_step_inference": True,  # TFT only
+    "attention_chunk_size": None,  # e.g. 64, for long lookbacks (TFT and Transformer)
+    "recompute_gradients": False,  # TFT only, checkpoints do not load across settings
+    "export_model": False,
+    "export_quantisation": None,  # or "float16" or "int8"
 }